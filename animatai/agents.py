@@ -6,12 +6,19 @@
 # Imports
 # =======
 
+import math
 import random
 
 from collections import defaultdict
+from time import perf_counter
+import numpy as np
 from gzutils.gzutils import DotDict, Logging, save_csv_file
 
-from .utils import turn_heading, distance_squared
+from .utils import turn_heading
+from .population import POPULATION_ACTIONS, Population, PopulationAgent
+from .things import Agent, Direction, NonSpatial, Registry, Thing
+# NamedObject and trace_agent used to be defined here, keep them importable from agents
+from .things import NamedObject, trace_agent # pylint: disable=unused-import
 
 
 # Setup constants and logging
@@ -24,95 +31,6 @@ l = Logging('agents', DEBUG_MODE)
 # The code
 # =========
 
-# Objects from this class are identified with their name (as opposed to the reference).
-class NamedObject:
-    def __init__(self, name=None):
-        self.__name__ = name
-
-    def __repr__(self):
-        return '<{} ({})>'.format(self.__name__, self.__class__.__name__)
-
-    def __eq__(self, other):
-        return self.__name__ == other.__name__
-
-    def __hash__(self):
-        return hash(self.__name__)
-
-
-# This represents any physical object that can appear in an Environment.
-# You subclass Thing to get the things you want.  Each thing can have a
-# .__name__  slot (used for output only)
-class Thing(NamedObject):
-    def __init__(self, name='noname'):
-        self.alive = None
-        self.location = None
-        super().__init__(name)
-
-    def __repr__(self):
-        return '<{} {} ({})>'.format(self.__name__, self.location, self.__class__.__name__)
-
-    # Things that are 'alive' should return true
-    def is_alive(self):
-        return hasattr(self, 'alive') and self.alive
-
-
-# This represents any non-spatial/physical artifact that can appear in an Environment.
-class NonSpatial(NamedObject):
-    pass
-
-
-# An Agent is a subclass of Thing with one required slot,
-# .program, which should hold a function that takes one argument, the
-# percept, and returns an action. (What counts as a percept or action
-# will depend on the specific environment in which the agent exists.)
-# Note that 'program' is a slot, not a method.  If it were a method,
-# then the program could 'cheat' and look at aspects of the agent.
-# It's not supposed to do that: the program can only look at the
-# percepts.  An agent program that needs a model of the world (and of
-# the agent itself) will have to build and maintain its own model.
-# There is an optional slot, .performance, which is a number giving
-# the performance measure of the agent in its environment.
-class Agent(Thing):
-    # pylint: disable=too-many-instance-attributes
-
-    def __init__(self, program=None, name='noname'):
-        super().__init__()
-        self.bump = False
-        self.alive = True
-        self.holding = []
-        self.__name__ = name
-        self.direction = Direction(Direction.R)
-        self.performance = 0
-        if program:
-            self.program = program
-
-    def __repr__(self):
-        return '<alive:{}, direction:{}, name:{} ({})>'.format(self.alive,
-                                                               self.direction,
-                                                               self.__name__,
-                                                               self.__class__.__name__)
-
-    # Returns True if this agent can grab this thing. Override for appropriate
-    # subclasses of Agent and Thing.
-    # _=thing
-    def can_grab(self, _):
-        return False
-
-
-# Wrap the agent's program to print its input and output. This will let
-# you see what the agent is doing in the environment.
-def trace_agent(agent):
-    old_program = agent.program
-
-    def new_program(percept):
-        action = old_program(percept)
-        print('{} perceives {} and does {}'.format(agent, percept, action))
-        return action
-    agent.program = new_program
-    return agent
-
-
-
 # Abstract class representing an Environment.  'Real' Environment classes
 # inherit from this. Your Environment will typically need to implement:
 # percept:           Define the percept that an agent sees.
@@ -128,20 +46,28 @@ class Environment:
         options = options or {}
         self.options = DotDict(options)
 
-        self.things = []
-        self.agents = []
+        self.things = Registry()
+        self.agents = Registry()
         self.actions = None
         self.rewards = None
         self.__name__ = name
         self.observers = defaultdict(list)
         self.non_spatials = {} # indexed with time
 
+        # nothing is logged or rendered when headless (see run)
+        self.headless = False
+        self.steps_per_second = None
+
 
         # These needs to be set in the subclass when rendering in the browser
         self.wss = None
         self.world = None
         self.wss_cfg = None
 
+        # [(x, y, code)] - cells in self.world changed by the last build_world,
+        # None when the whole world was built
+        self.changed_cells = None
+
     def __repr__(self):
         return '<things:{s.things}, agents:{s.agents}, non_spatials:{s.non_spatials} ({s.__class__.__name__}>)'.format(s=self)
 
@@ -190,7 +116,8 @@ class Environment:
     # override this method.
     def step(self, time):
         if not self.is_done():
-            l.info('--- STEP:', time, '---')
+            if not self.headless:
+                l.info('--- STEP:', time, '---')
             actions, actions1, rewards = self.actions, [], [{}]*len(self.agents) #[0]*len(self.agents)
 
             # use rewards for previous actions
@@ -206,56 +133,88 @@ class Environment:
                     if hasattr(agent, 'status'):
                         agent.alive = agent.alive and all([status > 0.0 for obj, status in agent.status.items()])
 
-                    for obs in self.observers[agent]:
-                        obs.agent_step(agent, percept, action, time)
+                    observers = self.observers.get(agent)
+                    if observers:
+                        for obs in observers:
+                            obs.agent_step(agent, percept, action, time)
 
                 actions1.append(action)
 
-            for obs in self.observers[self]:
-                obs.env_step(self)
+            observers = self.observers.get(self)
+            if observers:
+                for obs in observers:
+                    obs.env_step(self)
 
             # TODO: should be removed, using observers instead that can use Environment.calc_objects
             #self.save_history()
 
             # execute actions
-            rewards = []
-            for (agent, action1) in zip(self.agents, actions1):
-                rewards.append(self.calc_performance(agent, action1))
-
-                l.info(agent.__name__, 'alive:', agent.alive,
-                       ', location:', agent.location,
-                       ', action:', action1,
-                       ', status:', agent.status if hasattr(agent, 'status') else None,
-                       ', rewards to be applied in next step:', rewards)
-
-                self.execute_action(agent, action1, time)
+            rewards = self.execute_actions(actions1, time)
 
             self.actions = actions1
             self.rewards = rewards
 
             self.exogenous_change()
 
-            # render the updated world in the browser
-            self.build_world()
-            if self.world and self.wss and self.wss_cfg:
+            if not self.headless:
+                self.render()
+
+    # render the updated world in the browser
+    def render(self):
+        self.build_world()
+        if self.world and self.wss and self.wss_cfg:
+            if self.changed_cells is None:
                 self.wss.send_update_terrain('\n'.join(self.world))
+            elif self.changed_cells:
+                self.wss.send_update_cells(self.changed_cells)
+        if self.wss:
             for thing in self.things:
-                if self.wss and thing.__name__ in self.wss_cfg.agents:
+                if thing.__name__ in self.wss_cfg.agents:
                     self.wss_cfg.agents[thing.__name__]['pos'] = thing.location
                     self.wss.send_update_agent(thing.__name__, self.wss_cfg.agents[thing.__name__])
 
 
+    # Calculate the rewards for and execute the actions of all agents (in the
+    # same order as self.agents). Returns the rewards.
+    def execute_actions(self, actions, time):
+        rewards = []
+        for (agent, action) in zip(self.agents, actions):
+            rewards.append(self.calc_performance(agent, action))
+            if not self.headless:
+                self.log_action(agent, action, rewards)
+            self.execute_action(agent, action, time)
+        return rewards
+
+    def log_action(self, agent, action, rewards):
+        l.info(agent.__name__, 'alive:', agent.alive,
+               ', location:', agent.location,
+               ', action:', action,
+               ', status:', agent.status if hasattr(agent, 'status') else None,
+               ', rewards to be applied in next step:', rewards)
+
     # Override to calculate stats etc. at the end
     def finished(self):
         pass
 
-    # Run the Environment for given number of time steps
-    def run(self, steps=1000):
-        for i in range(steps):
-            if self.is_done():
-                #self.finished()
-                return
-            self.step(i)
+    # Run the Environment for given number of time steps. A headless run
+    # skips logging and rendering in the browser (observers are still notified).
+    # The speed of the run is saved in steps_per_second.
+    def run(self, steps=1000, headless=False):
+        self.headless = headless
+        start, done = perf_counter(), 0
+        try:
+            for i in range(steps):
+                if self.is_done():
+                    #self.finished()
+                    break
+                self.step(i)
+                done += 1
+        finally:
+            self.headless = False
+
+        elapsed = perf_counter() - start
+        self.steps_per_second = done / elapsed if elapsed > 0 else math.inf
+        l.info('Ran', done, 'steps,', '{0:.1f}'.format(self.steps_per_second), 'steps/second')
 
         #self.finished()
 
@@ -283,17 +242,19 @@ class Environment:
     # Add a thing to the environment, setting its location. For
     # convenience, if thing is an agent program we make a new agent
     # for it. (Shouldn't need to override this
+    # Returns the thing that was added or None if it already was in the environment
     def add_thing(self, thing, location=None):
         if not isinstance(thing, Thing):
             thing = Agent(thing)
         if thing in self.things:
             l.error("Can't add the same thing twice")
-        else:
-            thing.location = location if location is not None else self.default_location(thing)
-            self.things.append(thing)
-            if isinstance(thing, Agent):
-                thing.performance = 0
-                self.agents.append(thing)
+            return None
+        thing.location = location if location is not None else self.default_location(thing)
+        self.things.append(thing)
+        if isinstance(thing, Agent):
+            thing.performance = 0
+            self.agents.append(thing)
+        return thing
 
     # Add a non spatial to the environment, setting its time.
     # non_spatials added at `time` are available as percepts at `time+1`
@@ -317,6 +278,37 @@ class Environment:
         if thing in self.agents:
             self.agents.remove(thing)
 
+    # Snapshots
+    # ---------
+    #
+    # A snapshot saves the things in the environment and their state (see
+    # Thing.snapshot), the non spatials, the last actions and rewards and the
+    # state of the random generators. restore puts the environment back in the
+    # saved state, this makes it possible to do many rollouts from the same
+    # state. Data that doesn't change (options, terrain etc.) is shared and
+    # not copied.
+
+    def snapshot(self):
+        return {'things': [(thing, thing.snapshot()) for thing in self.things],
+                'agents': list(self.agents),
+                'non_spatials': {time: list(ns) for time, ns in self.non_spatials.items()},
+                'actions': self.actions and list(self.actions),
+                'rewards': self.rewards and list(self.rewards),
+                'random': random.getstate(),
+                'np_random': np.random.get_state()}
+
+    def restore(self, snapshot):
+        self.things = Registry()
+        for thing, state in snapshot['things']:
+            thing.restore(state)
+            self.things.append(thing)
+        self.agents = Registry(snapshot['agents'])
+        self.non_spatials = {time: list(ns) for time, ns in snapshot['non_spatials'].items()}
+        self.actions = snapshot['actions'] and list(snapshot['actions'])
+        self.rewards = snapshot['rewards'] and list(snapshot['rewards'])
+        random.setstate(snapshot['random'])
+        np.random.set_state(snapshot['np_random'])
+
     # Adds an observer to the list of observers.
     # An observer is typically an EnvGUI.
     # Each observer is notified of changes in move_to and add_thing,
@@ -329,58 +321,17 @@ class Environment:
         self.observers[observee].append(observer)
 
 
-# A direction class for agents that want to move in a 2D plane
-#    Usage:
-#        d = Direction("down")
-#        To change directions:
-#        d = d + "right" or d = d + Direction.R #Both do the same thing
-#        Note that the argument to __add__ must be a string and not a Direction object.
-#        Also, it (the argument) can only be right or left.
-class Direction:
-
-    R = "right"
-    L = "left"
-    U = "up"
-    D = "down"
-
-    def __init__(self, direction):
-        self.direction = direction
+# The offsets (dx, dy, radius^2 - dx^2 - dy^2) of the integer locations within
+# radius of (0, 0). Memoized for each radius.
+DISK_OFFSETS = {}
 
-    def __repr__(self):
-        return '{}'.format(self.direction)
-
-    def __add__(self, heading):
-        if self.direction == self.R:
-            return{
-                self.R: Direction(self.D),
-                self.L: Direction(self.U),
-            }.get(heading, None)
-        elif self.direction == self.L:
-            return{
-                self.R: Direction(self.U),
-                self.L: Direction(self.D),
-            }.get(heading, None)
-        elif self.direction == self.U:
-            return{
-                self.R: Direction(self.R),
-                self.L: Direction(self.L),
-            }.get(heading, None)
-        elif self.direction == self.D:
-            return{
-                self.R: Direction(self.L),
-                self.L: Direction(self.R),
-            }.get(heading, None)
-
-    def move_forward(self, from_location):
-        x, y = from_location
-        if self.direction == self.R:
-            return (x + 1, y)
-        elif self.direction == self.L:
-            return (x - 1, y)
-        elif self.direction == self.U:
-            return (x, y - 1)
-        elif self.direction == self.D:
-            return (x, y + 1)
+def disk_offsets(radius):
+    if radius not in DISK_OFFSETS:
+        radius2, r = radius * radius, math.floor(radius)
+        DISK_OFFSETS[radius] = [(dx, dy, radius2 - dx * dx - dy * dy)
+                                for dx in range(-r, r + 1) for dy in range(-r, r + 1)
+                                if dx * dx + dy * dy <= radius2]
+    return DISK_OFFSETS[radius]
 
 
 # This class is for environments on a 2D plane, with locations
@@ -389,6 +340,27 @@ class Direction:
 # environment has a .location slot which should be a location such
 # as (0, 1), and a .holding slot, which should be a list of things
 # that are held.
+#
+# Things are indexed by cell (the location rounded down to integers) so that
+# location and radius queries only look at the cells involved. The index is
+# kept up to date by add_thing, move_to and delete_thing, the location of
+# things in the environment should therefore be changed with move_to.
+#
+# cells: {(x, y): [thing1, ..., thingn]} - things in each cell, ordered as in self.things
+# continuous_count: int - number of things with a location that isn't integer
+# dirty_cells: {(x, y)} - cells where things have been added, moved or deleted since
+#                         the last build_world
+#
+# With the option `occupancy_layers` is a NumPy grid with the number of things
+# in each cell kept for each Thing class (the classes in ENV_ENCODING and classes
+# of other things added). Counting and testing for things of a class then don't
+# need to look at the things.
+#
+# layers: {class: np.array((height, width))} - number of things of class in each cell
+# class_counts: {class: int} - number of things of each class
+#
+# agent_population: Population - the PopulationAgents in the environment (None
+#                                until the first one is added)
 class XYEnvironment(Environment):
 
     # pylint: disable=too-many-instance-attributes, arguments-differ, too-many-public-methods
@@ -403,6 +375,12 @@ class XYEnvironment(Environment):
         self.thing_counter = 0
 
         self.ENV_ENCODING = options.ENV_ENCODING or []
+        self.class_codes = {}
+        self.agent_population = None
+
+        # rewards compiled by compile_rewards
+        self.reward_table = self.compiled_rewards = None
+        self.subclass_cache = {}
 
         # Sets iteration start and end (no walls).
         self.x_start, self.y_start = (0, 0)
@@ -413,6 +391,8 @@ class XYEnvironment(Environment):
             self.height = len(options.terrain)
             self.x_end, self.y_end = (self.width, self.height)
 
+        self.init_index()
+
         # build world from things and terrain
         if options.things:
             self.add_things(options.things)
@@ -447,10 +427,10 @@ class XYEnvironment(Environment):
     def class2envcode(self, class_):
         if not hasattr(self, 'ENV_ENCODING'):
             return None
-        res = [code for code, cls in self.ENV_ENCODING if cls == class_]
-        if res:
-            return res[0]
-        return None
+        if class_ not in self.class_codes:
+            res = [code for code, cls in self.ENV_ENCODING if cls == class_]
+            self.class_codes[class_] = res[0] if res else None
+        return self.class_codes[class_]
 
     # If there is spontaneous change in the world, override this
     def exogenous_change(self):
@@ -464,30 +444,82 @@ class XYEnvironment(Environment):
     #            None: { 'energy': -0.05 }
     #        },
     #
+    # The first reward found for each objective is used. Rewards for the action
+    # (or for the action None which matches all actions) are searched in the
+    # order they are specified in. Rewards for Things are used when there is
+    # at least one thing of the class at the location of the agent.
     def calc_performance(self, agent, action):
-        # pylint: disable=len-as-condition, too-many-nested-blocks
         # return 1 for test purposes for agents without objectives or rewards
         if ('objectives' not in self.options  or
                 'rewards' not in self.options):
-            l.info('calc_performance:objectives or rewards not configured.')
+            if not self.headless:
+                l.info('calc_performance:objectives or rewards not configured.')
             return 1
 
+        if self.compiled_rewards is not self.options.rewards:
+            self.compile_rewards()
+
+        entries = self.reward_table.get(action, self.reward_table[None])
+        classes = None
         rewards = {}
-        for rewarded_action, object_and_objectives in self.options.rewards.items():
-            if action == rewarded_action or rewarded_action is None:
-                for rewarded_thing, obj_and_reward in object_and_objectives.items():
-                    if (rewarded_thing and
-                            len(self.list_things_at(agent.location, rewarded_thing))):
-                        for obj, rew in obj_and_reward.items():
-                            if obj not in rewards:
-                                rewards[obj] = rew
-                    elif rewarded_thing is None:
-                        for obj, rew in obj_and_reward.items():
-                            if obj not in rewards:
-                                rewards[obj] = rew
+        for rewarded_thing, obj_and_reward in entries:
+            if rewarded_thing is not None:
+                if classes is None:
+                    classes = {thing.__class__ for thing in self.list_things_at(agent.location)}
+                if not self.any_subclass(classes, rewarded_thing):
+                    continue
+            for obj, rew in obj_and_reward.items():
+                if obj not in rewards:
+                    rewards[obj] = rew
 
         return rewards
 
+    # Compile the rewards in the options into a table with the rewards to check for
+    # each action {action: [(Thing class or None, {objective: reward})]}
+    def compile_rewards(self):
+        specs = list(self.options.rewards.items())
+        actions = [action for action, _ in specs if action is not None]
+        self.reward_table = {}
+        for action in actions + [None]:
+            self.reward_table[action] = [(rewarded_thing, obj_and_reward)
+                                         for rewarded_action, object_and_objectives in specs
+                                         if rewarded_action == action or rewarded_action is None
+                                         for rewarded_thing, obj_and_reward in object_and_objectives.items()
+                                         if rewarded_thing or rewarded_thing is None]
+        self.compiled_rewards = self.options.rewards
+
+    # True if any of the classes is tclass or a subclass of tclass
+    def any_subclass(self, classes, tclass):
+        cache = self.subclass_cache
+        for cls in classes:
+            key = (cls, tclass)
+            if key not in cache:
+                cache[key] = issubclass(cls, tclass)
+            if cache[key]:
+                return True
+        return False
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['thing_counter'] = self.thing_counter
+        return snapshot
+
+    # The index, occupancy layers and population are rebuilt and the world
+    # is built from scratch the next time it is rendered
+    def restore(self, snapshot):
+        if self.agent_population is not None:
+            for agent in list(self.agent_population.agents):
+                self.agent_population.remove(agent)
+            self.agent_population = None
+
+        super().restore(snapshot)
+        self.thing_counter = snapshot['thing_counter']
+        for agent in self.agents:
+            if isinstance(agent, PopulationAgent):
+                self.agent_population = self.agent_population or Population()
+                self.agent_population.add(agent)
+        self.reindex()
+
     # Adds things to the world using the spec. (list of strings) in the options
     def add_things(self, env):
         if not env:
@@ -499,29 +531,241 @@ class XYEnvironment(Environment):
             for x in range(0, width):
                 class_ = self.envcode2class(env[y][x])
                 if class_:
-                    l.info('add_things:', class_, self.thing_counter)
+                    if not self.headless:
+                        l.info('add_things:', class_, self.thing_counter)
                     self.add_thing(class_(str(self.thing_counter)), (x, y))
                     self.thing_counter += 1
 
     # build a spec. (list of strings) to be used by the browser when rendering the world
+    # The world is built once, after that are only the dirty cells updated
     def build_world(self):
         if not self.options.terrain:
+            self.dirty_cells = set()
             return
-        world = list(map(list, self.options.terrain))
+        if self.world_grid is None:
+            self.world_grid = list(map(list, self.options.terrain))
+            self.dirty_cells = set(self.cells)
+            self.build_cells()
+            self.world = list(map(''.join, self.world_grid))
+            self.changed_cells = None
+        else:
+            self.changed_cells = self.build_cells()
+            for y in {y for _, y, _ in self.changed_cells}:
+                self.world[y] = ''.join(self.world_grid[y])
+
+    # Update the dirty cells in self.world_grid, returns the cells that changed [(x, y, code)]
+    def build_cells(self):
+        res = []
+        terrain, grid = self.options.terrain, self.world_grid
+        for x, y in self.dirty_cells:
+            if not (0 <= y < len(grid) and 0 <= x < len(grid[y])):
+                continue
+            code = terrain[y][x]
+            for thing in self.cells.get((x, y), []):
+                code = self.class2envcode(thing.__class__) or code
+            if grid[y][x] != code:
+                grid[y][x] = code
+                res.append((x, y, code))
+        self.dirty_cells = set()
+        return res
+
+    # Spatial index
+    # -------------
+
+    # The cell a location belongs to, integer locations are their own cell
+    @staticmethod
+    def location2cell(location):
+        x, y = location
+        return (math.floor(x), math.floor(y))
+
+    def init_index(self):
+        self.cells = defaultdict(list)
+        self.continuous_count = 0
+        self.dirty_cells = set()
+
+        # list of lists with the codes in self.world
+        self.world_grid = None
+
+        self.layers = self.class_counts = None
+        self.subclass_layers = {}
+        if self.options.occupancy_layers:
+            self.layers = {cls: np.zeros((self.height, self.width), dtype=np.int32)
+                           for _, cls in self.ENV_ENCODING}
+            self.class_counts = defaultdict(int)
+
+    # Add thing to the cell of its location. The cell is kept in the same
+    # order as self.things
+    def index_thing(self, thing):
+        order = self.things.order
+        seq = order(thing)
+        key = self.location2cell(thing.location)
+        cell = self.cells[key]
+        i = len(cell)
+        while i and order(cell[i - 1]) > seq:
+            i -= 1
+        cell.insert(i, thing)
+        self.dirty_cells.add(key)
+        if key != thing.location:
+            self.continuous_count += 1
+        if self.layers is not None:
+            self.update_layers(thing, key, 1)
+
+    def unindex_thing(self, thing):
+        key = self.location2cell(thing.location)
+        cell = self.cells.get(key)
+        if cell is not None and thing in cell:
+            cell.remove(thing)
+            self.dirty_cells.add(key)
+            if not cell:
+                del self.cells[key]
+            if key != thing.location:
+                self.continuous_count -= 1
+            if self.layers is not None:
+                self.update_layers(thing, key, -1)
+
+    # Rebuild the index from self.things, necessary if locations have been changed
+    # without using move_to
+    def reindex(self):
+        self.init_index()
         for thing in self.things:
-            x, y = thing.location
-            s = self.class2envcode(thing.__class__)
-            if s:
-                world[y][x] = s
-        self.world = list(map(''.join, world))
+            self.index_thing(thing)
+
+    # Occupancy layers
+    # ----------------
+
+    def update_layers(self, thing, cell, inc):
+        cls = thing.__class__
+        self.class_counts[cls] += inc
+        x, y = cell
+        if 0 <= x < self.width and 0 <= y < self.height:
+            layer = self.layers.get(cls)
+            if layer is None:
+                layer = self.layers[cls] = np.zeros((self.height, self.width), dtype=np.int32)
+                self.subclass_layers = {}
+            layer[y, x] += inc
+
+    # The layers for tclass and its subclasses
+    def layers_for(self, tclass):
+        res = self.subclass_layers.get(tclass)
+        if res is None:
+            res = self.subclass_layers[tclass] = [layer for cls, layer in self.layers.items()
+                                                  if issubclass(cls, tclass)]
+        return res
+
+    # The layers can be used to answer questions about location when it is a
+    # cell within the grid and there are no things between the cells
+    def use_layers(self, location):
+        if self.layers is None or self.continuous_count:
+            return False
+        x, y = location
+        return (x == math.floor(x) and y == math.floor(y) and
+                0 <= x < self.width and 0 <= y < self.height)
+
+    # Number of things of class tclass at location
+    def count_things_at(self, location, tclass=Thing):
+        if not self.use_layers(location):
+            return len(self.list_things_at(location, tclass))
+        x, y = location
+        return int(sum(layer[y, x] for layer in self.layers_for(tclass)))
+
+    # Number of things of class tclass in each cell of the grid
+    def density(self, tclass=Thing):
+        if self.layers is None:
+            res = np.zeros((self.height, self.width), dtype=np.int32)
+            for thing in self.list_things(tclass):
+                x, y = self.location2cell(thing.location)
+                if 0 <= x < self.width and 0 <= y < self.height:
+                    res[y, x] += 1
+            return res
+        return sum(self.layers_for(tclass), np.zeros((self.height, self.width), dtype=np.int32))
+
+    # Number of things of each class in the environment {class: int}
+    def population(self):
+        if self.class_counts is None:
+            res = defaultdict(int)
+            for thing in self.things:
+                res[thing.__class__] += 1
+            return dict(res)
+        return {cls: count for cls, count in self.class_counts.items() if count}
+
+    # Return all things exactly at a given location
+    def list_things_at(self, location, tclass=Thing):
+        cell = self.cells.get(self.location2cell(location))
+        if not cell:
+            return []
+        if tclass is not Thing and self.use_layers(location) and not self.count_things_at(location, tclass):
+            return []
+        return [thing for thing in cell
+                if thing.location == location and isinstance(thing, tclass)]
 
-    # Return all things within radius of location.
+    # Return true if at least one of the things at location
+    # is an instance of class tclass (or a subclass)
+    def some_things_at(self, location, tclass=Thing):
+        if self.use_layers(location):
+            return self.count_things_at(location, tclass) > 0
+        return super().some_things_at(location, tclass)
+
+    # Return all things within radius of location [(thing, radius^2 - distance^2)].
+    # When all things are on integer locations are the cells within the radius
+    # given by disk_offsets, otherwise are the cells used as buckets and the
+    # distance to each thing in the buckets calculated.
     def things_near(self, location, radius=None):
         if radius is None:
             radius = PERCEPTIBLE_DISTANCE
+        x, y = location
+        if not self.continuous_count and x == math.floor(x) and y == math.floor(y):
+            near, res = self.grid_things_near(location, radius)
+        else:
+            near, res = self.bucket_things_near(location, radius)
+        if near > 1:
+            order = self.things.order
+            res.sort(key=lambda thing_rest: order(thing_rest[0]))
+        return res
+
+    # things_near for integer locations when all things are on integer locations.
+    # Returns the number of occupied cells and the unsorted things.
+    def grid_things_near(self, location, radius):
+        x, y = location
+        radius2, cells = radius * radius, self.cells
+        offsets = disk_offsets(radius)
+        if len(offsets) <= len(cells):
+            near = [(cells.get((x + dx, y + dy)), rest) for dx, dy, rest in offsets]
+        else:
+            near = [(cell, radius2 - (cx - x) ** 2 - (cy - y) ** 2)
+                    for (cx, cy), cell in cells.items()
+                    if (cx - x) ** 2 + (cy - y) ** 2 <= radius2]
+        near = [(cell, rest) for cell, rest in near if cell]
+        return len(near), [(thing, rest) for cell, rest in near for thing in cell]
+
+    # The occupied cells in the square around location. The cells in the square
+    # are visited, or the occupied cells when there are fewer of them.
+    def cells_near(self, location, radius):
+        x, y = location
+        cells = self.cells
+        x0, y0 = self.location2cell((x - radius, y - radius))
+        x1, y1 = self.location2cell((x + radius, y + radius))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(cells):
+            near = [cells.get((cx, cy)) for cx in range(x0, x1 + 1)
+                    for cy in range(y0, y1 + 1)]
+        else:
+            near = [cell for (cx, cy), cell in cells.items()
+                    if x0 <= cx <= x1 and y0 <= cy <= y1]
+        return [cell for cell in near if cell]
+
+    # things_near using the cells as buckets. Returns the number of occupied
+    # cells and the unsorted things.
+    def bucket_things_near(self, location, radius):
+        x, y = location
         radius2 = radius * radius
-        return [(thing, radius2 - distance_squared(location, thing.location))
-                for thing in self.things if distance_squared(location, thing.location) <= radius2]
+        near = self.cells_near(location, radius)
+        res = []
+        for cell in near:
+            for thing in cell:
+                tx, ty = thing.location
+                d2 = (x - tx) ** 2 + (y - ty) ** 2
+                if d2 <= radius2:
+                    res.append((thing, radius2 - d2))
+        return len(near), res
 
     # By default, agent perceives things within a default radius.
     def percept(self, agent, time):
@@ -558,6 +802,55 @@ class XYEnvironment(Environment):
         elif action == 'sing':
             self.add_non_spatial('song', time)
 
+    # The rewards for all agents are calculated before the actions are executed.
+    # Forward, TurnLeft and TurnRight of agents in the population are executed for
+    # all of them at once, after the actions of the other agents.
+    def execute_actions(self, actions, time):
+        if self.agent_population is None:
+            return super().execute_actions(actions, time)
+
+        rewards = []
+        for (agent, action) in zip(self.agents, actions):
+            rewards.append(self.calc_performance(agent, action))
+            if not self.headless:
+                self.log_action(agent, action, rewards)
+
+        indexes, codes = [], []
+        for (agent, action) in zip(self.agents, actions):
+            if action in POPULATION_ACTIONS and getattr(agent, 'population', None) is self.agent_population:
+                indexes.append(agent.index)
+                codes.append(POPULATION_ACTIONS[action])
+            else:
+                self.execute_action(agent, action, time)
+
+        if indexes:
+            self.execute_population_actions(indexes, codes)
+        return rewards
+
+    def execute_population_actions(self, indexes, codes):
+        population = self.agent_population
+        forward, destinations = population.execute(indexes, codes)
+        if not forward.size:
+            return
+
+        # check for obstacles, using the occupancy layers for destinations in the grid
+        xs, ys = destinations[:, 0], destinations[:, 1]
+        in_grid = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        if self.layers is not None and not self.continuous_count:
+            bump = np.zeros(len(forward), dtype=bool)
+            for layer in self.layers_for(Obstacle):
+                bump[in_grid] |= layer[ys[in_grid], xs[in_grid]] > 0
+            for i in np.flatnonzero(~in_grid):
+                bump[i] = self.some_things_at((int(xs[i]), int(ys[i])), Obstacle)
+        else:
+            bump = np.array([self.some_things_at((int(x), int(y)), Obstacle)
+                             for x, y in destinations.tolist()], dtype=bool)
+        population.bump[forward] = bump
+
+        agents = population.agents
+        for i, (x, y) in zip(forward[~bump].tolist(), destinations[~bump].tolist()):
+            self.move_thing(agents[i], (x, y))
+
     # _=thing
     def default_location(self, _):
         return (random.choice(self.width), random.choice(self.height))
@@ -567,18 +860,29 @@ class XYEnvironment(Environment):
     def move_to(self, thing, destination):
         thing.bump = self.some_things_at(destination, Obstacle)
         if not thing.bump:
-            thing.location = destination
-            if self.wss and self.wss_cfg.agents[thing.__name__]:
-                self.wss_cfg.agents[thing.__name__]['pos'] = thing.location
-                self.wss.send_update_agent(thing.__name__, self.wss_cfg.agents[thing.__name__])
-            for o in self.observers[self]:
-                o.thing_moved(thing)
-            for t in thing.holding:
-                self.delete_thing(t)
-                self.add_thing(t, destination)
-                t.location = destination
+            self.move_thing(thing, destination)
         return thing.bump
 
+    # Move a thing (and what it is holding) without checking for obstacles
+    def move_thing(self, thing, destination):
+        self.relocate(thing, destination)
+        if not self.headless and self.wss and self.wss_cfg.agents[thing.__name__]:
+            self.wss_cfg.agents[thing.__name__]['pos'] = thing.location
+            self.wss.send_update_agent(thing.__name__, self.wss_cfg.agents[thing.__name__])
+        for o in self.observers[self]:
+            o.thing_moved(thing)
+        for t in thing.holding:
+            self.relocate(t, destination)
+
+    # Change the location of a thing and update the index
+    def relocate(self, thing, destination):
+        if thing not in self.things:
+            thing.location = destination
+            return
+        self.unindex_thing(thing)
+        thing.location = destination
+        self.index_thing(thing)
+
     # Adds things to the world. If (exclude_duplicate_class_items) then the item won't be
     # added if the location has at least one item of the same class
     def add_thing(self, thing, location=(1, 1), exclude_duplicate_class_items=False):
@@ -586,7 +890,12 @@ class XYEnvironment(Environment):
             if (exclude_duplicate_class_items and
                     any(isinstance(t, thing.__class__) for t in self.list_things_at(location))):
                 return
-            super().add_thing(thing, location)
+            thing = super().add_thing(thing, location)
+            if thing:
+                if isinstance(thing, PopulationAgent):
+                    self.agent_population = self.agent_population or Population()
+                    self.agent_population.add(thing)
+                self.index_thing(thing)
 
     # Checks to make sure that the location is inbounds (within walls if we have walls)
     def is_inbounds(self, location):
@@ -607,11 +916,15 @@ class XYEnvironment(Environment):
     def delete_thing(self, thing):
         if isinstance(thing, Agent):
             for obj in thing.holding:
+                self.unindex_thing(obj)
                 super().delete_thing(obj)
                 for obs in self.observers[self]:
                     obs.thing_deleted(obj)
 
+        self.unindex_thing(thing)
         super().delete_thing(thing)
+        if isinstance(thing, PopulationAgent) and thing.population is self.agent_population:
+            self.agent_population.remove(thing)
         for obs in self.observers[self]:
             obs.thing_deleted(thing)
 
@@ -629,6 +942,9 @@ class XYEnvironment(Environment):
         self.x_end, self.y_end = (self.width - 1, self.height - 1)
 
     def calc_objects(self, cls):
+        if self.class_counts is not None:
+            return sum(count for tclass, count in self.class_counts.items()
+                       if issubclass(tclass, cls))
         return len(self.list_things(cls))
 
     # Save history for environment
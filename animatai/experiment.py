@@ -0,0 +1,105 @@
+# pylint: disable=missing-docstring, global-statement, invalid-name
+#
+# Run many independent simulations, in parallel using a pool of processes
+#
+# Copyright (C) 2017  Jonas Colmsjö, Claes Strannegård
+#
+
+# Imports
+# =======
+
+import random
+from multiprocessing import Pool
+
+import numpy as np
+from gzutils.gzutils import Logging
+
+from .history import History
+
+
+# Setup logging
+# =============
+
+DEBUG_MODE = True
+l = Logging('experiment', DEBUG_MODE)
+
+
+# The code
+# =========
+
+#
+# world_factory - a function config -> Environment that builds the world to run,
+#                 must be defined at the top level of a module so that it can be
+#                 sent to the processes in the pool
+# configs - a list with one config per run. The config is a dict (or an int that
+#           is used as seed). The random generators are seeded with config['seed']
+#           before the world is built.
+#
+# Each run returns a dict:
+#   {'config': config,
+#    'history': History.dump() - the history collected during the run,
+#    'agents': {agent name: {'performance':.., 'alive':.., 'location':.., ...}},
+#    'steps_per_second': float}
+#
+
+def get_seed(config):
+    if isinstance(config, dict):
+        return config.get('seed')
+    return config
+
+
+def agent_statistics(env):
+    res = {}
+    for agent in env.agents:
+        stats = {'performance': agent.performance,
+                 'alive': agent.alive,
+                 'location': agent.location}
+        if hasattr(agent, 'status'):
+            stats['status'] = dict(agent.status)
+        if hasattr(agent, 'iterations'):
+            stats['iterations'] = agent.iterations
+        res[agent.__name__] = stats
+    return res
+
+
+# Run a single world. The history collected during the run is returned and
+# removed from History (History is restored to what it was before the run).
+def run_experiment(world_factory, config, steps=1000):
+    saved = History.dump()
+    History.reset()
+    try:
+        seed = get_seed(config)
+        random.seed(seed)
+        np.random.seed(seed if seed is None else seed % 2**32)
+
+        env = world_factory(config)
+        env.run(steps, headless=True)
+        return {'config': config,
+                'history': History.dump(),
+                'agents': agent_statistics(env),
+                'steps_per_second': env.steps_per_second}
+    finally:
+        History.reset()
+        History.merge(saved)
+
+
+def run_experiment_(args):
+    return run_experiment(*args)
+
+
+# Run the world once for each config, using a pool with processes workers
+# (processes=1 runs in this process). The history of each run is merged into
+# History with the datasets prefixed with 'run<idx>'. Returns the results of
+# the runs in the same order as configs.
+def run_experiments(world_factory, configs, steps=1000, processes=None):
+    args = [(world_factory, config, steps) for config in configs]
+    if processes == 1:
+        results = list(map(run_experiment_, args))
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(run_experiment_, args)
+
+    for idx, result in enumerate(results):
+        History.merge(result['history'], 'run' + str(idx))
+    l.info('Finished', len(results), 'runs')
+    return results
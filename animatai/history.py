@@ -71,6 +71,46 @@ class History:
             res.extend([cls, env.calc_objects(cls)])
         History.add_row(env.__name__, tuple(res))
 
+    @staticmethod
+    def thing_moved(_):
+        pass
+
+    @staticmethod
+    def thing_deleted(_):
+        pass
+
+    # Remove all datasets
+    @staticmethod
+    def reset():
+        History.__history.clear()
+        History.__headers.clear()
+        History.__filenames.clear()
+        History.__env_classes.clear()
+
+    # Return all the collected history, can be pickled and merged with merge
+    @staticmethod
+    def dump():
+        return {'history': {ds: list(rows) for ds, rows in History.__history.items()},
+                'headers': {ds: list(headers) for ds, headers in History.__headers.items()},
+                'filenames': {fn: list(ds) for fn, ds in History.__filenames.items()},
+                'env_classes': dict(History.__env_classes)}
+
+    # Add the datasets in a dump, dataset names and headers are prefixed with prefix
+    # (if given) to keep apart datasets from different runs
+    @staticmethod
+    def merge(dump, prefix=None):
+        def name(x):
+            return x if prefix is None else '{}:{}'.format(prefix, x)
+
+        for filename, datasets in dump['filenames'].items():
+            for dataset in datasets:
+                History.add_dataset(name(dataset),
+                                    [name(header) for header in dump['headers'][dataset]],
+                                    filename)
+                History.__history[name(dataset)].extend(dump['history'][dataset])
+        for env_name, env_classes in dump['env_classes'].items():
+            History.__env_classes[name(env_name)] = env_classes
+
     @staticmethod
     def get_dataset(dataset):
         res = list(History.__headers[dataset])
@@ -4,11 +4,20 @@
 # Imports
 # =======
 
-import math
+import gc
+import io
 import os
+from collections import defaultdict
+from contextlib import contextmanager
+from heapq import heapify, heappop, heappush
 from random import random
+from time import perf_counter
+
+import numpy as np
 from gzutils.gzutils import Logging, get_output_dir
 
+from .network_layers import GATES, Layers, NetworkProfile
+
 
 # Setup logging
 # =============
@@ -23,14 +32,19 @@ l = Logging('network', DEBUG_MODE)
 # vars - the initial state the function executes in, necessary for SEQ (and other
 #        function that require a state)
 # children - indexes if the nodes that the nodes takes input from (used in the update function)
+# kind - the kind of node created by the factories below ('AND', 'SEQ' etc.), None for
+#        other nodes. Used when compiling the network, func is used otherwise.
+# args - the arguments of the kind of node (the n in MIN n etc.)
 #
 class Node:
-    # pylint: disable=too-few-public-methods
-    def __init__(self, type_, func, vars_, children):
+    # pylint: disable=too-few-public-methods, too-many-arguments
+    def __init__(self, type_, func, vars_, children, kind=None, args=None):
         self.type_ = type_
         self.vars_ = vars_
         self.func = func
         self.children = children
+        self.kind = kind
+        self.args = args
         self.last_res = None
 
     def __call__(self, percept):
@@ -44,48 +58,87 @@ class Node:
         return ('(' + self.type_ + ' - vars:' + str(self.vars_) +
                 ',children:' + str(self.children) + ')')
 
+# Bitset keys
+# -----------
+#
+# A set of node indexes can be represented with an int where bit i is set
+# when node i is active. Ints are hashed and compared much faster than frozensets.
+
+def state_to_key(state):
+    key = 0
+    for i, active in enumerate(state):
+        if active:
+            key |= 1 << i
+    return key
+
+def indexes_to_key(indexes):
+    key = 0
+    for i in indexes:
+        key |= 1 << i
+    return key
+
+def key_to_indexes(key):
+    return frozenset([i for i in range(key.bit_length()) if key >> i & 1])
+
+
+# Pause the garbage collector while many nodes are created, it would otherwise
+# run many times without finding anything to collect
+@contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# vars that are lists are updated in place by some nodes
+def copy_vars(vars_):
+    return list(vars_) if isinstance(vars_, list) else vars_
+
 # Create a sensor that recognise Things of type `cls`, radius is ignored
 def SENSOR_factory(cls, name=None):
     if name is None:
         return Node('SENSOR:' + cls.__name__,
                     lambda things, _: (any([isinstance(x, cls) for x, _ in things]), []),
-                    [], [])
+                    [], [], 'SENSOR', (cls, name))
     return Node('SENSOR:' + cls.__name__ + ":" + name,
                 lambda things, _: (any([isinstance(x, cls) and x.__name__ == name for x, _ in things]), []),
-                [], [])
+                [], [], 'SENSOR', (cls, name))
 
 
 def AND_factory(indexes, state):
     return Node('AND', lambda _, _2: (all([state[i] for i in indexes]), []),
-                [], indexes)
+                [], indexes, 'AND')
 
 def OR_factory(indexes, state):
     return Node('OR', lambda _, _2: (any([state[i] for i in indexes]), []),
-                [], indexes)
+                [], indexes, 'OR')
 
 def ONE_factory(index, indexes, state):
     return Node('ONE:'+str(index),
                 lambda _, _2: (all([state[index] if i == index
                                     else not state[i]
                                     for i in indexes]), []),
-                [], indexes)
+                [], indexes, 'ONE', index)
 
 def MIN_factory(n, indexes, state):
     return Node('MIN:'+str(n), lambda _, _2: ([state[i] for i in indexes].count(True) >= n, []),
-                [], indexes)
+                [], indexes, 'MIN', n)
 
 def MAX_factory(n, indexes, state):
     return Node('MAX:'+str(n), lambda _, _2: ([state[i] for i in indexes].count(True) <= n, []),
-                [], indexes)
+                [], indexes, 'MAX', n)
 
 # _=indexes, _2=state
 def RAND_factory(prob):
     return Node('RAND-'+str(prob), lambda _, _2: (random() < prob, []),
-                [], [])
+                [], [], 'RAND', prob)
 
 def NOT_factory(indexes, state):
     return Node('NOT', lambda _, _2: (all([not state[i] for i in indexes]), []),
-                [], indexes)
+                [], indexes, 'NOT')
 
 # t:state[idx1] followed by t+1:state[idx2]
 # NOTE: the value of t:state[idx2] and t+1:state[idx1] makes no difference
@@ -94,26 +147,104 @@ def NOT_factory(indexes, state):
 #                lambda things, vars_: (bool(vars_[0]) and state[idx2], [state[idx1]]),
 #                [None], [idx1, idx2])
 
-# Create a counter initially set to 0 each time state[index] is true.
-# Update state[children[counter]] each time update is called.
-# Increase the counter until all children have been updated, then delete it.
-# Many counters can exist at the same time.
-# vars = [counter1, ..., countern]
+# A shift register where bit j is set when the sequence that started j steps
+# ago has matched children[0], ..., children[j] so far. A new sequence is started
+# each time update is called (and only kept when state[children[0]] is true).
+# The SEQ node is true when a sequence has matched all children. Only the set
+# bits are checked, so the cost of an update is independent of len(children).
+# vars = int with bits 0 to len(children) - 2
 def SEQ_factory(children, state):
-    def update(_, vars_):
-        # the (seq, counter) tuples are stored in reverse order in vars_
-        if state[children[0]]:
-            vars_.insert(0, (True, 0))
-        new_vars = []
-        seq = False
-        counter = math.inf
-        for seq, counter in vars_:
-            seq = seq and state[children[counter]]
-            if counter < len(children) - 1:
-                new_vars.append((seq, counter + 1))
+    return Node('SEQ', lambda _, vars_: seq_step(vars_, children, state), 0, children, 'SEQ')
+
+# One update of a SEQ shift register with the current values of the nodes.
+# Returns (matched, the new register).
+def seq_step(register, children, values):
+    last = len(children) - 1
+    candidates, matched = register << 1 | 1, 0
+    while candidates:
+        bit = candidates & -candidates
+        if values[children[bit.bit_length() - 1]]:
+            matched |= bit
+        candidates ^= bit
+    return (bool(matched >> last), matched & ((1 << last) - 1))
+
+
+# The indexes of the nodes in depth first order starting in roots, children
+# before parents. Each node is visited once and without recursion, so deep
+# networks can be used. The roots and children are visited in reversed order
+# when reverse is True.
+def post_order(nodes, roots, reverse=False):
+    order = reversed if reverse else iter
+    visited = [False] * len(nodes)
+    res = []
+    for root in order(roots):
+        if visited[root]:
+            continue
+        visited[root] = True
+        stack = [(root, order(nodes[root].children))]
+        while stack:
+            idx, children = stack[-1]
+            for child in children:
+                if not visited[child]:
+                    visited[child] = True
+                    stack.append((child, order(nodes[child].children)))
+                    break
+            else:
+                stack.pop()
+                res.append(idx)
+    return res
+
+
+# The values of a SEQ node for steps time steps. At time t the sequence that
+# started at time t-k+1 is matched. Sequences that started before time 0 use the
+# register in vars_ for the part before time 0.
+def replay_SEQ(node, values, steps):
+    k = len(node.children)
+    res = np.ones(steps, dtype=bool)
+    for j, child in enumerate(node.children):
+        shift = k - 1 - j
+        if shift < steps:
+            res[shift:] &= values[child, :steps - shift]
+    for t in range(min(k - 1, steps)):
+        res[t] &= bool(node.vars_ >> (k - 2 - t) & 1)
+    return res
+
+
+#
+# Sensors
+# -------
+#
+# Dispatch table used to update all SENSOR nodes in one pass over the percept.
+# The sensors that match a class are looked up the first time a Thing of that
+# class is perceived: (indexes of sensors without name, {name: [indexes]}).
+#
+class Sensors:
+
+    def __init__(self, nodes, plan):
+        self.indexes = [idx for idx in plan if nodes[idx].kind == 'SENSOR']
+        self.sensors = [(idx,) + nodes[idx].args for idx in self.indexes]
+        self.dispatch = {}
+
+    def lookup(self, cls):
+        unnamed, named = [], defaultdict(list)
+        for idx, cls_, name in self.sensors:
+            if issubclass(cls, cls_):
+                if name is None:
+                    unnamed.append(idx)
+                else:
+                    named[name].append(idx)
+        self.dispatch[cls] = res = (unnamed, dict(named))
+        return res
 
-        return (seq and counter == len(children) - 1, new_vars)
-    return Node('SEQ', update, [], children)
+    # Return the indexes of the active sensors (with duplicates)
+    def __call__(self, things):
+        dispatch, active = self.dispatch, []
+        for thing, _ in things:
+            unnamed, named = dispatch.get(thing.__class__) or self.lookup(thing.__class__)
+            active += unnamed
+            if named:
+                active += named.get(getattr(thing, '__name__', None), [])
+        return active
 
 
 #
@@ -121,16 +252,46 @@ def SEQ_factory(children, state):
 #         have been added to the network (AND, SEQ etc.)
 # nodes - a list of Node objects used to calculate the values for the SENSORS and
 #         other types of nodes (AND, SEQ etc.)
-# root_nodes - the root Nodes in the trees that makes up the network
+# root_nodes - the root Nodes in the trees that makes up the network, the nodes
+#              that are not children of other nodes. Computed when needed.
 #
 class Network:
-    # pylint: disable=too-many-public-methods
+    # pylint: disable=too-many-public-methods, too-many-instance-attributes
 
     # sensors = [('sensor name', Thing to recognise)]
-    def __init__(self, sensors=None, needs=None):
+    # bitset - get() and top_active() return an int with one bit per active
+    #          node instead of a frozenset of indexes
+    # vectorized - evaluate the gates in layers using NumPy, see Layers
+    # incremental - only update the nodes downstream of the sensors that changed
+    #               since the last update (and SEQ, RAND etc.), see propagate
+    def __init__(self, sensors=None, needs=None, bitset=False, vectorized=False,
+                 incremental=False):
+        # pylint: disable=too-many-arguments
+        self.bitset = bitset
+        self.vectorized = vectorized
+        self.incremental = incremental
         self.state = []
         self.nodes = []
-        self.root_nodes = []
+        # indexes of the root nodes, None when nodes have been added or deleted
+        self.roots = None
+        # the indexes of the nodes in the order they are evaluated, compiled
+        # by compile() and invalidated when nodes are added or deleted. The
+        # SENSOR nodes are updated using sensors, the others using func_plan.
+        self.plan = None
+        self.sensors = None
+        self.func_plan = None
+        self.layers = None
+        # parents of each node, position of each node in the plan and the plan
+        # positions of the nodes that are updated in each step (all but SENSORs
+        # and gates)
+        self.parents = None
+        self.position = None
+        self.ticked = None
+        # the active sensors after the last update, None when all nodes must
+        # be updated
+        self.active_sensors = None
+        # NetworkProfile when profiling, see start_profiling
+        self.profile = None
         if sensors:
             self.add_sensors(sensors)
         self.needs = {}
@@ -154,68 +315,385 @@ class Network:
             res += str(self.nodes.index(node)) + ','
         return res
 
-    def toGraphviz(self, color_edges=False):
+    # Write the network in the Graphviz DOT format to filep, one line at the time.
+    # The filters (see graphviz_nodes) make it possible to write parts of large
+    # networks.
+    # profile - add the statistics in a NetworkProfile to the labels, nodes that
+    #           never have been active are gray and the nodes that have used
+    #           more than half of the time of the most expensive node are red
+    def writeGraphviz(self, filep, color_edges=False, profile=None, **filters):
         colors = ['black', 'blue', 'brown', 'cyan', 'darkgreen', 'deeppink', 'gold']
-        res = 'digraph G {\n\tsize ="8,8";\n'
-        for i in range(0, len(self.nodes)):
-            res += '\t{} [label="{}\\n{}\\n{}"];\n'.format(i, i,
-                                                           self.nodes[i].type_,
-                                                           self.state[i])
-            res += '\tedge [color={}];\n'.format(colors[i % len(colors)]) if color_edges else ''
-            for child in self.nodes[i].children:
-                res += '\t{}->{};\n'.format(child, i)
-        res += '}'
+        include = self.graphviz_nodes(**filters)
+        filep.write('digraph G {\n\tsize ="8,8";\n')
+        if profile:
+            profile.resize(len(self.nodes))
+            max_time = max(profile.times + [0.0])
+        for i, node in enumerate(self.nodes):
+            if not include[i]:
+                continue
+            if profile:
+                fill = ('lightgray' if profile.counts[i] and not profile.activations[i] else
+                        'salmon' if max_time and profile.times[i] > max_time / 2 else 'white')
+                filep.write(('\t{} [label="{}\\n{}\\n{}\\nn={} t={:.2e}s f={:.2f}", '
+                             'style=filled, fillcolor={}];\n').format(
+                                 i, i, node.type_, self.state[i], profile.counts[i],
+                                 profile.times[i], profile.frequency(i), fill))
+            else:
+                filep.write('\t{} [label="{}\\n{}\\n{}"];\n'.format(i, i, node.type_,
+                                                                      self.state[i]))
+            if color_edges:
+                filep.write('\tedge [color={}];\n'.format(colors[i % len(colors)]))
+            for child in node.children:
+                if include[child]:
+                    filep.write('\t{}->{};\n'.format(child, i))
+        filep.write('}')
+
+    # Select the nodes to include in the Graphviz output, all (not deleted)
+    # nodes by default:
+    # around - only nodes at most radius edges (in any direction) from these nodes
+    # active_only - only nodes that are active
+    # max_depth - only nodes at most max_depth edges below the root nodes
+    def graphviz_nodes(self, around=None, radius=1, active_only=False, max_depth=None):
+        nodes = self.nodes
+        include = [node is not None for node in nodes]
+        if around is not None:
+            neighbours = [[] for _ in nodes]
+            for idx, node in enumerate(nodes):
+                if node:
+                    for child in node.children:
+                        neighbours[idx].append(child)
+                        neighbours[child].append(idx)
+            include = self.breadth_first(include, neighbours, around, radius)
+        if max_depth is not None:
+            children = [node.children if node else [] for node in nodes]
+            include = self.breadth_first(include, children, self.root_indexes(), max_depth)
+        if active_only:
+            include = [selected and bool(self.state[idx]) for idx, selected in enumerate(include)]
+        return include
+
+    @staticmethod
+    def breadth_first(include, edges, start, distance):
+        res = [False] * len(include)
+        frontier = [idx for idx in start if include[idx]]
+        for idx in frontier:
+            res[idx] = True
+        for _ in range(distance):
+            next_frontier = []
+            for idx in frontier:
+                for other in edges[idx]:
+                    if include[other] and not res[other]:
+                        res[other] = True
+                        next_frontier.append(other)
+            frontier = next_frontier
         return res
 
-    def saveGraphviz(self, filename, output_dir=None):
-        # Save the performance history to file
+    def toGraphviz(self, color_edges=False, profile=None, **filters):
+        res = io.StringIO()
+        self.writeGraphviz(res, color_edges, profile, **filters)
+        return res.getvalue()
+
+    def saveGraphviz(self, filename, output_dir=None, **filters):
+        # Save the network to file
         if not output_dir:
             output_dir = get_output_dir('/../output', __file__)
         output_path = os.path.join(output_dir, filename)
-        filep = open(output_path, 'w')
-        print(self.toGraphviz(), file=filep)
-        filep.close()
-
-    # the state of the network is updated using a depth first search starting
-    # in the root nodes.
+        with open(output_path, 'w') as filep:
+            self.writeGraphviz(filep, **filters)
+            filep.write('\n')
+
+    # The nodes are evaluated in the order of a depth first search starting in
+    # the root nodes, children before parents. Each node is visited once, so
+    # shared children are only evaluated once. Nodes that can't be reached from
+    # the root nodes are not part of the plan.
+    def compile(self):
+        plan = post_order(self.nodes, self.root_indexes())
+        self.plan = plan
+        self.sensors = Sensors(self.nodes, plan)
+        self.func_plan = [idx for idx in plan if self.nodes[idx].kind != 'SENSOR']
+
+        self.parents = [[] for _ in self.nodes]
+        self.position = [None] * len(self.nodes)
+        for pos, idx in enumerate(plan):
+            self.position[idx] = pos
+            for child in self.nodes[idx].children:
+                self.parents[child].append(idx)
+        self.ticked = [pos for pos, idx in enumerate(plan)
+                       if self.nodes[idx].kind not in GATES + ('SENSOR',)]
+        return plan
+
+    def get_plan(self):
+        return self.plan if self.plan is not None else self.compile()
+
+    # the root nodes are computed in one pass over the nodes
+    def root_indexes(self):
+        if self.roots is None:
+            is_child = [False] * len(self.nodes)
+            for node in self.nodes:
+                if node:
+                    for child in node.children:
+                        is_child[child] = True
+            self.roots = [idx for idx, node in enumerate(self.nodes)
+                          if node and not is_child[idx]]
+        return self.roots
+
+    @property
+    def root_nodes(self):
+        return [self.nodes[idx] for idx in self.root_indexes()]
+
+    def get_sensors(self):
+        self.get_plan()
+        return self.sensors
+
+    def get_layers(self):
+        if self.layers is None:
+            self.layers = Layers(self.nodes, self.get_plan(), self.sensors)
+        return self.layers
+
+    def invalidate(self):
+        self.roots = self.plan = self.sensors = self.func_plan = self.layers = None
+        self.parents = self.position = self.ticked = self.active_sensors = None
+
+    # the state of the network is updated by first setting the SENSORs and
+    # then evaluating the other nodes in the order of the compiled plan.
     def update(self, percept):
         percepts, rewards = percept
         self.update_NEEDs(rewards)
-        for node in self.nodes:
-            node.last_res = None
-        for node in self.root_nodes:
-            self.update_node(node, percepts)
+        if self.profile is not None:
+            self.update_profiled(percepts)
+            return (self.get(), rewards)
+        sensors = self.get_sensors()
+        active = set(sensors(percepts))
+        if self.incremental and self.active_sensors is not None:
+            changed = active ^ self.active_sensors
+            for idx in changed:
+                self.state[idx] = idx in active
+            self.propagate(percepts, changed)
+        elif self.vectorized:
+            self.get_layers().update(self, percepts, list(active))
+        else:
+            state, nodes = self.state, self.nodes
+            for idx in sensors.indexes:
+                state[idx] = idx in active
+            for idx in self.func_plan:
+                node = nodes[idx]
+                node.last_res, node.vars_ = node.func(percepts, node.vars_)
+                state[idx] = node.last_res
+        self.active_sensors = active
         return (self.get(), rewards)
 
-    def update_node(self, node, percept):
-        idx = self.nodes.index(node)
-        for i in node.children:
-            self.update_node(self.nodes[i], percept)
-        self.state[idx] = node(percept)
+    # Offline replay
+    # --------------
+    #
+    # Evaluate the network for a whole time series at once and return a T x nodes
+    # array with the state of the nodes in each step. The state of the network
+    # is not changed, SEQ nodes start from their current registers.
+    # percepts - a list with T percepts, or a T x nodes array where the columns
+    #            of the SENSORs are used (see sensor_matrix)
+    # The gates are evaluated for all steps at once and a SEQ node with k children
+    # is computed as an AND of its children shifted k-1, ..., 0 steps. RAND nodes
+    # use np.random. Only nodes created by the factories can be replayed.
+    def replay(self, percepts):
+        layers, nodes = self.get_layers(), self.nodes
+        for funcs, _ in layers.stages:
+            for idx in funcs:
+                if nodes[idx].kind not in ('SEQ', 'RAND'):
+                    raise ValueError('Network: cannot replay node ' + nodes[idx].type_)
+
+        if isinstance(percepts, np.ndarray):
+            values = np.zeros((len(nodes), len(percepts)), dtype=bool)
+            sensors = self.sensors.indexes
+            values[sensors] = percepts.T[sensors]
+        else:
+            values = self.sensor_matrix(percepts).T.copy()
+
+        steps = values.shape[1]
+        for funcs, gates in layers.stages:
+            for idx in funcs:
+                node = nodes[idx]
+                if node.kind == 'RAND':
+                    values[idx] = np.random.random(steps) < node.args
+                else:
+                    values[idx] = replay_SEQ(node, values, steps)
+            if gates:
+                gates(values)
+        return values.T
+
+    # The SENSOR columns of a T x nodes array for the percepts
+    def sensor_matrix(self, percepts):
+        sensors = self.get_sensors()
+        res = np.zeros((len(percepts), len(self.nodes)), dtype=bool)
+        for step, percept in enumerate(percepts):
+            res[step, sensors(percept)] = True
+        return res
+
+    # Profiling
+    # ---------
+    #
+    # When profiling, the nodes are updated one at the time in the order of the
+    # plan (vectorized and incremental are not used) and timed.
+
+    def start_profiling(self):
+        self.profile = NetworkProfile()
+        return self.profile
+
+    def stop_profiling(self):
+        profile, self.profile = self.profile, None
+        return profile
+
+    def profile_report(self):
+        return self.profile.report(self.nodes)
+
+    def update_profiled(self, percepts):
+        state, nodes, sensors, profile = (self.state, self.nodes, self.get_sensors(),
+                                          self.profile)
+        profile.resize(len(nodes))
+        profile.steps += 1
+        start = perf_counter()
+        active = set(sensors(percepts))
+        elapsed = (perf_counter() - start) / max(1, len(sensors.indexes))
+        for idx in sensors.indexes:
+            state[idx] = idx in active
+            profile.record(idx, elapsed, state[idx])
+        for idx in self.func_plan:
+            node = nodes[idx]
+            start = perf_counter()
+            node.last_res, node.vars_ = node.func(percepts, node.vars_)
+            profile.record(idx, perf_counter() - start, node.last_res)
+            state[idx] = node.last_res
+        self.active_sensors = active
+
+    # Update the parents of the nodes in changed, and the nodes that are updated
+    # in every step, in the order of the plan. The parents of a node are only
+    # updated when the value of the node changes. The nodes updated in every
+    # step (self.ticked, positions in the plan) are already in order and are
+    # merged with the heap, which only holds the parents of changed nodes.
+    def propagate(self, percepts, changed):
+        state, nodes, parents, position = self.state, self.nodes, self.parents, self.position
+        queue = [position[parent] for idx in changed for parent in parents[idx]]
+        heapify(queue)
+        ticked, next_ticked, last = self.ticked, 0, None
+        while queue or next_ticked < len(ticked):
+            if next_ticked < len(ticked) and (not queue or ticked[next_ticked] <= queue[0]):
+                pos = ticked[next_ticked]
+                next_ticked += 1
+            else:
+                pos = heappop(queue)
+            if pos == last:
+                continue
+            last = pos
+            idx = self.plan[pos]
+            node = nodes[idx]
+            node.last_res, node.vars_ = node.func(percepts, node.vars_)
+            if node.last_res != state[idx]:
+                state[idx] = node.last_res
+                for parent in parents[idx]:
+                    heappush(queue, position[parent])
 
     def get_state(self):
         return tuple(self.state)
 
-    # return a set of indexes for the nodes that are active
+    # Return the network as a dict with the topology, the state of the nodes,
+    # the variables of nodes with state (SEQ etc.) and the NEEDs. The SENSOR
+    # classes are kept as classes so the dict can be pickled but not saved as JSON.
+    # Only nodes created by the factories can be saved.
+    def to_dict(self):
+        nodes = []
+        for node in self.nodes:
+            if node and node.kind not in NODE_FACTORIES:
+                raise ValueError('Network: cannot save node ' + node.type_)
+            nodes.append(node and (node.kind, node.args, list(node.children),
+                                   copy_vars(node.vars_)))
+        return {'options': {'bitset': self.bitset, 'vectorized': self.vectorized,
+                            'incremental': self.incremental},
+                'nodes': nodes,
+                'root_nodes': self.root_indexes(),
+                'state': list(self.state),
+                'needs': dict(self.needs),
+                'needs_initial': dict(self.needs_initial)}
+
+    # Create the nodes directly using the factories, the saved root nodes are
+    # used instead of computing them
+    def load_dict(self, data):
+        Network.__init__(self, **data['options'])
+        self.state = list(data['state'])
+        with paused_gc():
+            for idx, node in enumerate(data['nodes']):
+                if node:
+                    kind, args, children, vars_ = node
+                    node = NODE_FACTORIES[kind](idx, args, list(children), self.state)
+                    node.vars_ = copy_vars(vars_)
+                self.nodes.append(node)
+        self.roots = list(data['root_nodes'])
+        self.needs = dict(data['needs'])
+        self.needs_initial = dict(data['needs_initial'])
+
+    @classmethod
+    def from_dict(cls, data):
+        network = cls.__new__(cls)
+        network.load_dict(data)
+        return network
+
+    # The nodes are closures and can't be pickled, the dict is pickled instead
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, data):
+        self.load_dict(data)
+
+    # Return the state of the network: the state of the nodes, the variables of
+    # nodes with state (SEQ etc.) and the NEEDs. The topology is not saved.
+    def snapshot(self):
+        return {'state': list(self.state),
+                'vars': [copy_vars(node.vars_) if node else None for node in self.nodes],
+                'needs': dict(self.needs)}
+
+    # Restore a snapshot of this network. The state list and NEEDs dict are
+    # updated in place since nodes and agents keep references to them.
+    def restore(self, snapshot):
+        self.active_sensors = None
+        self.state[:] = snapshot['state']
+        for node, vars_ in zip(self.nodes, snapshot['vars']):
+            if node:
+                node.vars_ = copy_vars(vars_)
+        self.needs.clear()
+        self.needs.update(snapshot['needs'])
+
+    # return a set of indexes for the nodes that are active (or an int with
+    # the bits of the active nodes set when using bitset)
     def get(self):
-        res = set()
-        for i in range(0, len(self.state)):
-            if self.state[i]:
-                res |= {i}
-        return frozenset(list(res))
+        if self.bitset:
+            return state_to_key(self.state)
+        return frozenset([i for i, active in enumerate(self.state) if active])
 
     def add_root_node(self, node):
+        self.invalidate()
         self.state.append(None)
         self.nodes.append(node)
-        self.root_nodes.append(node)
         return len(self.state) - 1
 
-    # when other nodes than SENSORs are added are the nodes below no longer
-    # root nodes
-    def delete_root_nodes(self, indexes):
-        for i in indexes:
-            if self.nodes[i] in self.root_nodes:
-                self.root_nodes.remove(self.nodes[i])
+    # Add many nodes at once, specs is a list of (kind, args, children) where
+    # kind is a key in NODE_FACTORIES and args the arguments for the kind
+    # of node (see Node). Children can be nodes earlier in specs. Returns the
+    # indexes of the new nodes. Nothing is added when a spec is invalid.
+    def add_nodes(self, specs):
+        self.invalidate()
+        nodes, res = self.nodes, []
+        start = len(nodes)
+        try:
+            with paused_gc():
+                for kind, args, children in specs:
+                    idx = len(nodes)
+                    for child in children:
+                        if not 0 <= child < idx or nodes[child] is None:
+                            raise ValueError('Network: invalid child ' + str(child))
+                    nodes.append(NODE_FACTORIES[kind](idx, args, list(children), self.state))
+                    self.state.append(None)
+                    res.append(idx)
+        except Exception:
+            del nodes[start:]
+            del self.state[start:]
+            raise
+        return res
 
     def add_SENSOR_node(self, cls, name=None):
         return self.add_root_node(SENSOR_factory(cls, name))
@@ -224,34 +702,22 @@ class Network:
         return self.add_root_node(RAND_factory(prob))
 
     def add_AND_node(self, indexes):
-        idx = self.add_root_node(AND_factory(indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(AND_factory(indexes, self.state))
 
     def add_OR_node(self, indexes):
-        idx = self.add_root_node(OR_factory(indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(OR_factory(indexes, self.state))
 
     def add_ONE_node(self, index, indexes):
-        idx = self.add_root_node(ONE_factory(index, indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(ONE_factory(index, indexes, self.state))
 
     def add_MIN_node(self, n, indexes):
-        idx = self.add_root_node(MIN_factory(n, indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(MIN_factory(n, indexes, self.state))
 
     def add_MAX_node(self, n, indexes):
-        idx = self.add_root_node(MAX_factory(n, indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(MAX_factory(n, indexes, self.state))
 
     def add_NOT_node(self, indexes):
-        idx = self.add_root_node(NOT_factory(indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(NOT_factory(indexes, self.state))
 
 #    def add_SEQ_node(self, idx1, idx2):
 #        idx = self.add_root_node(SEQ_factory(idx1, idx2, self.state))
@@ -259,9 +725,7 @@ class Network:
 #        return idx
 
     def add_SEQ_node(self, indexes):
-        idx = self.add_root_node(SEQ_factory(indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(SEQ_factory(indexes, self.state))
 
     def add_NEEDs(self, objective_initial):
         self.needs = {**self.needs, **objective_initial}
@@ -276,29 +740,34 @@ class Network:
             self.needs[objective] += reward
             self.needs[objective] = min(self.needs_initial[objective], self.needs[objective])
 
+    # the children of the deleted nodes become root nodes unless they are
+    # children of other nodes
     def delete_nodes(self, indexes):
-        self.delete_root_nodes(indexes)
+        self.invalidate()
         for idx in indexes:
-            for child in self.nodes[idx].children:
-                self.root_nodes.append(self.nodes[child])
             self.nodes[idx] = self.state[idx] = None
 
-    def top_active_(self, node):
-        idx = self.nodes.index(node)
-        if self.state[idx]:
-            return {idx}
-        res = set()
-        for child in node.children:
-            res |= self.top_active_(self.nodes[child])
-        return res
-
+    # The active nodes that are reached from the root nodes without passing
+    # another active node. Each node is visited once.
     def top_active(self, percept=None):
         if percept:
             self.update(percept)
-        res = set()
-        for node in self.root_nodes:
-            res |= self.top_active_(node)
-        return frozenset(list(res))
+        state, nodes = self.state, self.nodes
+        visited = [False] * len(nodes)
+        stack = list(self.root_indexes())
+        res = []
+        while stack:
+            idx = stack.pop()
+            if visited[idx]:
+                continue
+            visited[idx] = True
+            if state[idx]:
+                res.append(idx)
+            else:
+                stack += nodes[idx].children
+        if self.bitset:
+            return indexes_to_key(res)
+        return frozenset(res)
 
 
 #
@@ -323,32 +792,31 @@ class Network:
 def MOTOR_factory(name):
     return Node('MOTOR:' + name,
                 lambda _, _2: (None, []),
-                [], [])
+                [], [], 'MOTOR', name)
 
 def MAND_factory(index, children, state):
     def update(_, _2):
         for idx in children:
             state[idx] = state[index]
         return (None, [])
-    return Node('MAND', update, [], children)
+    return Node('MAND', update, [], children, 'MAND')
 
-# Create a counter initially set to 0 each time state[index] is true.
-# Update state[children[counter]] each time update is called.
-# Increase the counter until all children have been updated, then delete it.
-# Many counters can exist at the same time.
-# vars = [counter1, ..., countern]
+# A shift register where bit j is set when state[children[j]] should be set.
+# Bit 0 is set each time state[index] is true and all bits are shifted one step
+# each time update is called, until all children have been updated.
+# vars = int with bits 0 to len(children) - 1
 def MSEQ_factory(index, children, state):
+    keep = (1 << len(children)) - 1
     def update(_, vars_):
         if state[index]:
-            vars_.append(0)
-        new_vars = []
-        for counter in vars_:
-            state[children[counter]] = True
-            if counter < len(children) - 1:
-                new_vars.append(counter + 1)
-
-        return (None, new_vars)
-    return Node('MSEQ', update, [], children)
+            vars_ |= 1
+        counters = vars_
+        while counters:
+            bit = counters & -counters
+            state[children[bit.bit_length() - 1]] = True
+            counters ^= bit
+        return (None, vars_ << 1 & keep)
+    return Node('MSEQ', update, 0, children, 'MSEQ')
 
 
 class MotorNetwork(Network):
@@ -362,7 +830,13 @@ class MotorNetwork(Network):
         # indexes of each MOTOR in self.state
         self.motors = []
         self.motor_names = []
-        self.motors_to_action = motors_to_action or {'*': '-'}
+
+        # compiled by compile_actions(): the nodes to update (parents before
+        # children), the bit of each motor and {motor bitmask: action}. The
+        # action table is rebuilt when motors_to_action is assigned, call
+        # invalidate() after changing motors_to_action in place.
+        self.motor_plan = self.motor_bits = self.action_table = None
+        self._motors_to_action = motors_to_action or {'*': '-'}
 
         for name in motor_names:
             self.add_MOTOR_node(name)
@@ -374,32 +848,92 @@ class MotorNetwork(Network):
                 ', root_nodes:' + str(self.root_nodes) +
                 ', motors:' + str(self.motors))
 
+    @property
+    def motors_to_action(self):
+        return self._motors_to_action
+
+    @motors_to_action.setter
+    def motors_to_action(self, motors_to_action):
+        self._motors_to_action = motors_to_action
+        self.action_table = None
+
+    def invalidate(self):
+        super().invalidate()
+        self.motor_plan = self.motor_bits = self.action_table = None
+
+    # The nodes are updated parents first (a reversed post order), so each node
+    # is updated once and after all nodes that set it. Roots and children are
+    # visited in reversed order so that trees are updated in the same order as
+    # a depth first search from the root nodes. MOTORs do nothing and are not
+    # part of the motor plan. Bit i of the motor bitmask is set when node i is
+    # active.
+    def compile_actions(self):
+        order = post_order(self.nodes, self.root_indexes(), True)
+        self.motor_plan = [idx for idx in reversed(order) if self.nodes[idx].kind != 'MOTOR']
+        self.motor_bits = [(idx, 1 << idx) for idx in self.motors]
+        self.compile_action_table()
+
+    def compile_action_table(self):
+        self.action_table = {indexes_to_key(motors): action
+                             for motors, action in self.motors_to_action.items()
+                             if isinstance(motors, (set, frozenset))}
+
     # indexes is a set with the indexes of the nodes that should be True
     def update(self, percept):
         # pylint disable=arguments-differ
-        for idx in range(0, len(self.state)):
-            self.state[idx] = idx in percept if percept else False
-        for node in self.root_nodes:
-            self.update_node(node, None)
+        if self.motor_plan is None:
+            self.compile_actions()
+        state, nodes = self.state, self.nodes
+        state[:] = [False] * len(state)
+        for idx in percept or ():
+            state[idx] = True
+        for idx in self.motor_plan:
+            node = nodes[idx]
+            _, node.vars_ = node.func(None, node.vars_)
         return self.get_action()
 
-    def update_node(self, node, percept):
-        node(None)
-        for i in node.children:
-            self.update_node(self.nodes[i], None)
+    # return the motor bitmask of the motors that are active
+    def get_mask(self):
+        mask, state = 0, self.state
+        for idx, bit in self.motor_bits:
+            if state[idx]:
+                mask |= bit
+        return mask
 
     # return a (frozen)set of indexes for the motors that are active
     def get(self):
-        res = set()
-        for i in self.motors:
-            if self.state[i]:
-                res |= {i}
-        return frozenset(list(res))
+        return frozenset([idx for idx in self.motors if self.state[idx]])
+
+    def to_dict(self):
+        data = super().to_dict()
+        data['motors'] = list(self.motors)
+        data['motor_names'] = list(self.motor_names)
+        data['motors_to_action'] = dict(self.motors_to_action)
+        return data
+
+    def load_dict(self, data):
+        super().load_dict(data)
+        self.motors = list(data['motors'])
+        self.motor_names = list(data['motor_names'])
+        self.motors_to_action = dict(data['motors_to_action'])
+        self.motor_plan = self.motor_bits = self.action_table = None
 
     def get_action(self):
-        action = self.motors_to_action.get(self.get(), None)
+        if self.motor_plan is None:
+            self.compile_actions()
+        elif self.action_table is None:
+            self.compile_action_table()
+        action = self.action_table.get(self.get_mask(), None)
         return action or self.motors_to_action['*']
 
+    def add_nodes(self, specs):
+        res = super().add_nodes(specs)
+        for idx, (kind, name, _) in zip(res, specs):
+            if kind == 'MOTOR':
+                self.motor_names.append(name)
+                self.motors.append(idx)
+        return res
+
     def add_MOTOR_node(self, name):
         self.motor_names.append(name)
         idx = self.add_root_node(MOTOR_factory(name))
@@ -407,11 +941,25 @@ class MotorNetwork(Network):
         return idx
 
     def add_MAND_node(self, indexes):
-        idx = self.add_root_node(MAND_factory(len(self.state), indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(MAND_factory(len(self.state), indexes, self.state))
 
     def add_MSEQ_node(self, indexes):
-        idx = self.add_root_node(MSEQ_factory(len(self.state), indexes, self.state))
-        self.delete_root_nodes(indexes)
-        return idx
+        return self.add_root_node(MSEQ_factory(len(self.state), indexes, self.state))
+
+
+# Create the nodes saved by Network.to_dict
+# kind: (index of the node, args, children, state) -> Node
+NODE_FACTORIES = {
+    'SENSOR': lambda _, args, _2, _3: SENSOR_factory(*args),
+    'AND': lambda _, _2, children, state: AND_factory(children, state),
+    'OR': lambda _, _2, children, state: OR_factory(children, state),
+    'NOT': lambda _, _2, children, state: NOT_factory(children, state),
+    'ONE': lambda _, index, children, state: ONE_factory(index, children, state),
+    'MIN': lambda _, n, children, state: MIN_factory(n, children, state),
+    'MAX': lambda _, n, children, state: MAX_factory(n, children, state),
+    'RAND': lambda _, prob, _2, _3: RAND_factory(prob),
+    'SEQ': lambda _, _2, children, state: SEQ_factory(children, state),
+    'MOTOR': lambda _, name, _2, _3: MOTOR_factory(name),
+    'MAND': lambda idx, _, children, state: MAND_factory(idx, children, state),
+    'MSEQ': lambda idx, _, children, state: MSEQ_factory(idx, children, state),
+}
@@ -0,0 +1,204 @@
+# pylint: disable=missing-docstring, invalid-name
+#
+
+# Imports
+# =======
+
+from random import random
+
+import numpy as np
+
+from .network import indexes_to_key, seq_step
+from .network_layers import GATES, Layers
+
+
+#
+# BatchNetwork
+# ------------
+#
+# Evaluates the topology of a network for many agents at once. The state of
+# the nodes is an array with one column per agent, the SEQ nodes keep one
+# shift register per agent and the NEEDs are arrays with one value per agent.
+# The network is used as a template and is not updated.
+#
+# Only nodes created by the factories can be used. RAND nodes use np.random
+# (one draw per agent) so the results differ from updating each network with
+# random().
+#
+# A SEQ node with k children has a register with k rows. Row j is True for an
+# agent when a sequence that started j steps ago is still matching, which is
+# the same as bit j of the register stored in vars_ by SEQ_factory.
+#
+class BatchNetwork:
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, network, size):
+        for node in network.nodes:
+            if node and node.kind not in GATES + ('SENSOR', 'RAND', 'SEQ'):
+                raise ValueError('BatchNetwork: unsupported node ' + node.type_)
+
+        self.bitset = network.bitset
+        self.size = size
+        self.nodes = network.nodes
+        self.sensors = network.get_sensors()
+        self.layers = Layers(network.nodes, network.get_plan(), self.sensors)
+        self.values = np.zeros((len(network.nodes), size), dtype=bool)
+
+        self.registers = {}
+        for idx in self.layers.plan:
+            node = self.nodes[idx]
+            if node.kind == 'SEQ':
+                register = np.zeros((len(node.children), size), dtype=bool)
+                for j in range(len(node.children)):
+                    register[j] = node.vars_ >> j & 1
+                self.registers[idx] = register
+
+        self.needs_initial = dict(network.needs_initial)
+        self.needs = {objective: np.full(size, value, dtype=float)
+                      for objective, value in network.needs.items()}
+
+    # percepts - a list with one (percept, rewards) tuple per agent, the same
+    #            as the input to Network.update
+    # Returns a list with the state (see Network.get) of each agent.
+    def update(self, percepts):
+        self.update_NEEDs([rewards for _, rewards in percepts])
+        values = self.values
+        values[self.sensors.indexes] = False
+        for agent, (percept, _) in enumerate(percepts):
+            values[self.sensors(percept), agent] = True
+        for funcs, gates in self.layers.stages:
+            for idx in funcs:
+                self.update_node(idx)
+            if gates:
+                gates(values)
+        return self.get()
+
+    def update_node(self, idx):
+        node, values = self.nodes[idx], self.values
+        if node.kind == 'RAND':
+            values[idx] = np.random.random(self.size) < node.args
+        else:
+            register = self.registers[idx]
+            register[1:] = register[:-1]
+            register[0] = True
+            register &= values[node.children]
+            values[idx] = register[-1]
+
+    def update_NEEDs(self, rewards):
+        for agent, rewards_ in enumerate(rewards):
+            for objective, reward in rewards_.items():
+                self.needs[objective][agent] += reward
+        for objective, needs in self.needs.items():
+            np.minimum(needs, self.needs_initial[objective], out=needs)
+
+    def get_NEEDs(self, agent):
+        return {objective: float(needs[agent]) for objective, needs in self.needs.items()}
+
+    def get_state(self, agent):
+        return tuple(self.values[:, agent].tolist())
+
+    # The bitset keys are created from the bytes of the columns (packbits puts
+    # the first row in the most significant bit so the rows are reversed)
+    def get(self):
+        if self.bitset:
+            padding = -len(self.values) % 8
+            packed = np.packbits(self.values[::-1], axis=0).T
+            return [int.from_bytes(column.tobytes(), 'big') >> padding for column in packed]
+        return [frozenset(np.flatnonzero(column).tolist()) for column in self.values.T]
+
+
+#
+# Topology and SharedNetwork
+# --------------------------
+#
+# A Topology is compiled once from a network and shared by many agents. Each
+# agent has a SharedNetwork that only holds its own state: the state of the
+# nodes (one byte per node), the SEQ registers (one int per SEQ node) and the
+# NEEDs. SharedNetwork can be used instead of Network in agents, the state is
+# the same as when updating a copy of the template network that has not been
+# updated yet. Only nodes created by the factories can be shared.
+#
+class Topology:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, network):
+        for node in network.nodes:
+            if node and node.kind not in GATES + ('SENSOR', 'RAND', 'SEQ'):
+                raise ValueError('Topology: unsupported node ' + node.type_)
+
+        self.bitset = network.bitset
+        self.size = len(network.nodes)
+        self.sensors = network.get_sensors()
+        self.layers = Layers(network.nodes, network.get_plan(), self.sensors)
+
+        # (kind, prob) for RAND and (kind, position of the register, children)
+        # for SEQ nodes, see seq_step
+        self.funcs = {}
+        self.register_count = 0
+        for funcs, _ in self.layers.stages:
+            for idx in funcs:
+                node = network.nodes[idx]
+                if node.kind == 'RAND':
+                    self.funcs[idx] = ('RAND', node.args)
+                else:
+                    self.funcs[idx] = ('SEQ', self.register_count, tuple(node.children))
+                    self.register_count += 1
+
+        # agents start with empty SEQ registers and the initial NEEDs, the
+        # current state of the template network is not used
+        self.needs_initial = dict(network.needs_initial)
+
+
+class SharedNetwork:
+    __slots__ = ('topology', 'values', 'registers', 'needs')
+
+    def __init__(self, topology):
+        self.topology = topology
+        self.values = np.zeros(topology.size, dtype=bool)
+        self.registers = [0] * topology.register_count
+        self.needs = dict(topology.needs_initial)
+
+    def update(self, percept):
+        percepts, rewards = percept
+        self.update_NEEDs(rewards)
+        topology, values, registers = self.topology, self.values, self.registers
+        values[:] = False
+        values[topology.sensors(percepts)] = True
+        for funcs, gates in topology.layers.stages:
+            for idx in funcs:
+                func = topology.funcs[idx]
+                if func[0] == 'RAND':
+                    values[idx] = random() < func[1]
+                else:
+                    _, pos, children = func
+                    values[idx], registers[pos] = seq_step(registers[pos], children, values)
+            if gates:
+                gates(values)
+        return (self.get(), rewards)
+
+    def get(self):
+        indexes = np.flatnonzero(self.values).tolist()
+        if self.topology.bitset:
+            return indexes_to_key(indexes)
+        return frozenset(indexes)
+
+    def get_state(self):
+        return tuple(self.values.tolist())
+
+    def get_NEEDs(self):
+        return self.needs
+
+    def update_NEEDs(self, rewards):
+        needs_initial = self.topology.needs_initial
+        for objective, reward in rewards.items():
+            self.needs[objective] = min(needs_initial[objective], self.needs[objective] + reward)
+
+    def snapshot(self):
+        return {'values': self.values.copy(), 'registers': list(self.registers),
+                'needs': dict(self.needs)}
+
+    def restore(self, snapshot):
+        self.values[:] = snapshot['values']
+        self.registers[:] = snapshot['registers']
+        self.needs.clear()
+        self.needs.update(snapshot['needs'])
@@ -0,0 +1,167 @@
+# pylint: disable=missing-docstring, invalid-name
+#
+
+# Imports
+# =======
+
+import numpy as np
+
+
+#
+# Layers
+# ------
+#
+# The network compiled into stages that are evaluated in order. The gates (AND,
+# OR, NOT, ONE, MIN and MAX) are grouped by depth and each group is evaluated
+# with a few NumPy operations. The other nodes (SENSOR, RAND, SEQ and nodes
+# without a kind) are evaluated one at the time with their func, in the order
+# of the plan, before the gates at the same depth.
+#
+# All gates count how many of their children that have the required value
+# (False for NOT, True for the index in ONE and True otherwise) and are True
+# when the count is between lo and hi.
+#
+
+GATES = ('AND', 'OR', 'NOT', 'ONE', 'MIN', 'MAX')
+
+def gate_bounds(node):
+    n = len(node.children)
+    if node.kind == 'NOT':
+        return [False] * n, n, n
+    if node.kind == 'ONE':
+        return [i == node.args for i in node.children], n, n
+    if node.kind == 'OR':
+        return [True] * n, 1, n
+    if node.kind == 'MIN':
+        return [True] * n, node.args, n
+    if node.kind == 'MAX':
+        return [True] * n, 0, node.args
+    return [True] * n, n, n
+
+
+class GateLayer:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, nodes, indexes):
+        flat, req, starts, ends, lo, hi = [], [], [], [], [], []
+        for idx in indexes:
+            node = nodes[idx]
+            req_, lo_, hi_ = gate_bounds(node)
+            starts.append(len(flat))
+            flat += node.children
+            req += req_
+            ends.append(len(flat))
+            lo.append(lo_)
+            hi.append(hi_)
+        self.indexes = np.array(indexes, dtype=np.intp)
+        self.flat = np.array(flat, dtype=np.intp)
+        self.req = np.array(req, dtype=bool)
+        self.starts = np.array(starts, dtype=np.intp)
+        self.ends = np.array(ends, dtype=np.intp)
+        self.lo = np.array(lo, dtype=np.int64)
+        self.hi = np.array(hi, dtype=np.int64)
+
+    # values - array with one row per node, and optionally one column per agent
+    #          or time step. The rows of the gates are set.
+    def __call__(self, values):
+        req, lo, hi = self.req, self.lo, self.hi
+        if values.ndim > 1:
+            req, lo, hi = req[:, None], lo[:, None], hi[:, None]
+        counts = np.zeros((len(self.flat) + 1,) + values.shape[1:], dtype=np.int64)
+        np.cumsum(values[self.flat] == req, axis=0, out=counts[1:])
+        count = counts[self.ends] - counts[self.starts]
+        values[self.indexes] = (count >= lo) & (count <= hi)
+
+
+class Layers:
+    # pylint: disable=too-few-public-methods
+
+    # stages - [(indexes of the nodes evaluated with func, GateLayer or None)]
+    # sensors - the SENSOR nodes (see Sensors), these are set before the stages
+    def __init__(self, nodes, plan, sensors):
+        levels = {}
+        stages = []
+        for idx in plan:
+            node = nodes[idx]
+            level = 1 + max(levels[child] for child in node.children) if node.children else 0
+            levels[idx] = level
+            while len(stages) <= level:
+                stages.append(([], []))
+            if node.kind != 'SENSOR':
+                stages[level][1 if node.kind in GATES else 0].append(idx)
+
+        self.size = len(nodes)
+        self.plan = plan
+        self.sensors = sensors
+        self.unplanned = sorted(set(range(len(nodes))) - set(plan))
+        self.stages = [(funcs, GateLayer(nodes, gates) if gates else None)
+                       for funcs, gates in stages]
+
+    # Update the state of the network. The state list is updated in one go at
+    # the end, the children of nodes that are evaluated with func are copied
+    # to the state list before the func is called.
+    # active - the indexes of the active sensors
+    def update(self, network, percepts, active):
+        state, nodes = network.state, network.nodes
+        values = np.zeros(self.size, dtype=bool)
+        values[active] = True
+        for funcs, gates in self.stages:
+            for idx in funcs:
+                node = nodes[idx]
+                for child in node.children:
+                    state[child] = bool(values[child])
+                node.last_res, node.vars_ = node.func(percepts, node.vars_)
+                values[idx] = state[idx] = bool(node.last_res)
+            if gates:
+                gates(values)
+
+        keep = [state[idx] for idx in self.unplanned]
+        state[:] = values.tolist()
+        for idx, value in zip(self.unplanned, keep):
+            state[idx] = value
+
+
+#
+# NetworkProfile
+# --------------
+#
+# Statistics per node collected by Network.update when profiling: the number
+# of times the node has been evaluated, the time used and the number of times
+# it has been active. The time used to set the SENSORs is shared equally
+# between them since they are set in one pass over the percept.
+#
+class NetworkProfile:
+
+    def __init__(self):
+        self.steps = 0
+        self.counts = []
+        self.times = []
+        self.activations = []
+
+    def resize(self, size):
+        missing = size - len(self.counts)
+        if missing > 0:
+            self.counts += [0] * missing
+            self.times += [0.0] * missing
+            self.activations += [0] * missing
+
+    def record(self, idx, elapsed, active):
+        self.counts[idx] += 1
+        self.times[idx] += elapsed
+        if active:
+            self.activations[idx] += 1
+
+    def frequency(self, idx):
+        return self.activations[idx] / self.counts[idx] if self.counts[idx] else 0.0
+
+    # A list with one dict per node, the most expensive nodes first
+    def report(self, nodes):
+        self.resize(len(nodes))
+        res = [{'node': idx, 'type': node.type_, 'count': self.counts[idx],
+                'time': self.times[idx], 'frequency': self.frequency(idx)}
+               for idx, node in enumerate(nodes) if node]
+        return sorted(res, key=lambda x: -x['time'])
+
+    # Nodes that have been evaluated but never been active
+    def dead_nodes(self):
+        return [idx for idx, count in enumerate(self.counts)
+                if count and not self.activations[idx]]
@@ -29,6 +29,7 @@ from collections import defaultdict
 from gzutils.gzutils import DefaultDict, Logging
 
 from .agents import Agent
+from .network import key_to_indexes
 
 
 # Setup logging
@@ -44,17 +45,24 @@ l = Logging('network_rl', DEBUG_MODE)
 #
 # A variant of a MDP where:
 # - actions are generated from active motors - frozenset([m0,...,mn])
-# - states are represented with active network nodes - frozenset([s1,..., sn])
+# - states are represented with active network nodes - frozenset([s1,..., sn]),
+#   or an int with bit si set for each active node when the network uses bitset
 # - statuses are used instead of terminal states. Any status less than or equal
 #   to zero is equivalent to a terminal state - [(name, float)]
 # - init is the initial state of the sensors
 #
 
 # Use like this: NetworkModel({frozenset([0]): state, ...})
+# Int keys (from networks using bitset) are also looked up as frozensets of the
+# indexes of the bits that are set.
 class NetworkModel(dict):
     def __call__(self, key):
         if key in self:
             return self.get(key)
+        if isinstance(key, int) and not isinstance(key, bool):
+            indexes = key_to_indexes(key)
+            if indexes in self:
+                return self.get(indexes)
         return key
 
 
@@ -176,6 +184,31 @@ class NetworkAgent(Agent):
         self.in_terminal = False
         self.ndp.reset()
 
+    # The history lists only grow, it is enough to save their lengths
+    def snapshot(self):
+        state = super().snapshot()
+        state.update({'s': self.s, 'ps': self.ps, 'a': self.a, 'pa': self.pa,
+                      'r': self.r and dict(self.r), 'pr': self.pr and dict(self.pr),
+                      'iterations': self.iterations,
+                      'in_terminal': self.in_terminal,
+                      'statuses': dict(self.ndp.statuses),
+                      'history': (len(self.history), len(self.ndp.history),
+                                  {status: len(history)
+                                   for status, history in self.status_history.items()})})
+        return state
+
+    def restore(self, state):
+        state = dict(state)
+        history, ndp_history, status_history = state.pop('history')
+        del self.history[history:]
+        del self.ndp.history[ndp_history:]
+        for status, length in status_history.items():
+            del self.status_history[status][length:]
+        self.ndp.statuses = dict(state.pop('statuses'))
+        state['r'] = state['r'] and dict(state['r'])
+        state['pr'] = state['pr'] and dict(state['pr'])
+        super().restore(state)
+
     # keep count of the number of iterations and check if the limit is reached
     def check_iterations(self):
         self.iterations += 1
@@ -308,6 +341,24 @@ class NetworkQLearningAgent(NetworkAgent):
             res[status] = U, pi
         return res
 
+    def snapshot(self):
+        state = super().snapshot()
+        state['Q'] = {status: self.copy_Q(Q) for status, Q in self.Q.items()}
+        state['Nsa'] = dict(self.Nsa)
+        return state
+
+    def restore(self, state):
+        state = dict(state)
+        self.Q = {status: self.copy_Q(Q) for status, Q in state.pop('Q').items()}
+        self.Nsa = defaultdict(float, state.pop('Nsa'))
+        super().restore(state)
+
+    @staticmethod
+    def copy_Q(Q):
+        res = DefaultDict(Q.default)
+        res.update(Q)
+        return res
+
     # check if status is zero or less and keep track of number of
     # iterations and stop after some limit has been reached
     def check_terminal(self):
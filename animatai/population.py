@@ -0,0 +1,157 @@
+# pylint: disable=missing-docstring, invalid-name
+#
+
+# Imports
+# =======
+
+import numpy as np
+
+from .things import Agent, Direction
+
+
+# Population
+# ----------
+#
+# Agents in large multi-agent runs can be stored as a population. Positions,
+# headings, alive flags, bump flags and performance of all agents are then kept
+# in NumPy arrays and the actions Forward, TurnLeft and TurnRight are executed for
+# all agents at once (see XYEnvironment.execute_actions). The agents in the
+# population are PopulationAgents, views that read and write the arrays, so
+# agent programs work as for other agents. Locations must be integers.
+#
+# Headings are indexes in HEADINGS, turning right adds one.
+
+HEADINGS = [Direction.R, Direction.D, Direction.L, Direction.U]
+HEADING_INDEX = {heading: i for i, heading in enumerate(HEADINGS)}
+HEADING_MOVES = np.array([(1, 0), (0, 1), (-1, 0), (0, -1)], dtype=np.int64)
+
+# codes for the actions executed by the population
+FORWARD, TURN_LEFT, TURN_RIGHT = 1, 2, 3
+POPULATION_ACTIONS = {'Forward': FORWARD, 'TurnLeft': TURN_LEFT, 'TurnRight': TURN_RIGHT}
+
+
+# size - number of agents in the population
+# agents - the PopulationAgents, agents[i] is the view of row i in the arrays
+# locations, headings, alive, bump, performance - arrays with one row per agent
+class Population:
+    # pylint: disable=too-many-instance-attributes
+
+    ATTRIBUTES = ['location', 'direction', 'alive', 'bump', 'performance']
+
+    def __init__(self, capacity=16):
+        self.size = 0
+        self.agents = []
+        self.locations = np.zeros((capacity, 2), dtype=np.int64)
+        self.headings = np.zeros(capacity, dtype=np.int8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.bump = np.zeros(capacity, dtype=bool)
+        self.performance = np.zeros(capacity, dtype=float)
+
+    def __repr__(self):
+        return '<size:{} ({})>'.format(self.size, self.__class__.__name__)
+
+    def __len__(self):
+        return self.size
+
+    def arrays(self):
+        return [self.locations, self.headings, self.alive, self.bump, self.performance]
+
+    def grow(self):
+        capacity = max(2 * len(self.alive), 16)
+        self.locations, self.headings, self.alive, self.bump, self.performance = [
+            np.concatenate((arr, np.zeros((capacity - len(arr),) + arr.shape[1:], dtype=arr.dtype)))
+            for arr in self.arrays()]
+
+    def get(self, attribute, i):
+        # pylint: disable=too-many-return-statements
+        if attribute == 'location':
+            x, y = self.locations[i]
+            return (int(x), int(y))
+        if attribute == 'direction':
+            return Direction(HEADINGS[self.headings[i]])
+        if attribute == 'alive':
+            return bool(self.alive[i])
+        if attribute == 'bump':
+            return bool(self.bump[i])
+        return float(self.performance[i])
+
+    def set(self, attribute, i, value):
+        if attribute == 'location':
+            self.locations[i] = value if value is not None else (0, 0)
+        elif attribute == 'direction':
+            self.headings[i] = HEADING_INDEX[value.direction]
+        elif attribute == 'alive':
+            self.alive[i] = bool(value)
+        elif attribute == 'bump':
+            self.bump[i] = bool(value)
+        else:
+            self.performance[i] = value
+
+    # Move the attributes of the agent into the arrays
+    def add(self, agent):
+        if self.size == len(self.alive):
+            self.grow()
+        i = self.size
+        self.size += 1
+        self.agents.append(agent)
+        values, agent.detached = agent.detached, {}
+        agent.population, agent.index = self, i
+        for attribute in self.ATTRIBUTES:
+            self.set(attribute, i, values.get(attribute))
+
+    # Move the attributes of the agent out of the arrays. The last agent takes its place.
+    def remove(self, agent):
+        i, last = agent.index, self.size - 1
+        values = {attribute: self.get(attribute, i) for attribute in self.ATTRIBUTES}
+        for arr in self.arrays():
+            arr[i] = arr[last]
+        self.agents[i] = self.agents[last]
+        self.agents[i].index = i
+        self.agents.pop()
+        self.size -= 1
+        agent.population, agent.index, agent.detached = None, None, values
+
+    # Turn the agents with index in indexes and return the indexes and destinations of
+    # the agents moving forward. codes are the codes of the actions in POPULATION_ACTIONS.
+    def execute(self, indexes, codes):
+        indexes, codes = np.asarray(indexes), np.asarray(codes)
+        headings = self.headings
+        self.bump[indexes] = False
+
+        right = indexes[codes == TURN_RIGHT]
+        headings[right] = (headings[right] + 1) % 4
+        left = indexes[codes == TURN_LEFT]
+        headings[left] = (headings[left] + 3) % 4
+
+        forward = indexes[codes == FORWARD]
+        return forward, self.locations[forward] + HEADING_MOVES[headings[forward]]
+
+
+def population_attribute(attribute):
+    def fget(self):
+        if self.population is None:
+            return self.detached.get(attribute)
+        return self.population.get(attribute, self.index)
+
+    def fset(self, value):
+        if self.population is None:
+            self.detached[attribute] = value
+        else:
+            self.population.set(attribute, self.index, value)
+    return property(fget, fset)
+
+
+# An agent with location, direction etc. stored in a Population. The agent is
+# added to the population of the environment it is added to.
+class PopulationAgent(Agent):
+    location = population_attribute('location')
+    direction = population_attribute('direction')
+    alive = population_attribute('alive')
+    bump = population_attribute('bump')
+    performance = population_attribute('performance')
+
+    def __init__(self, program=None, name='noname'):
+        self.population = None
+        self.index = None
+        self.detached = {}
+        super().__init__(program, name)
@@ -0,0 +1,216 @@
+# pylint: disable=missing-docstring, too-few-public-methods, invalid-name
+#
+# Adapted from https://github.com/aimacode/aima-python
+
+# The things, agents and directions used by the environments in agents.py
+
+
+# Objects from this class are identified with their name (as opposed to the reference).
+class NamedObject:
+    def __init__(self, name=None):
+        self.__name__ = name
+
+    def __repr__(self):
+        return '<{} ({})>'.format(self.__name__, self.__class__.__name__)
+
+    def __eq__(self, other):
+        return self.__name__ == other.__name__
+
+    def __hash__(self):
+        return hash(self.__name__)
+
+
+# This represents any physical object that can appear in an Environment.
+# You subclass Thing to get the things you want.  Each thing can have a
+# .__name__  slot (used for output only)
+class Thing(NamedObject):
+    def __init__(self, name='noname'):
+        self.alive = None
+        self.location = None
+        super().__init__(name)
+
+    def __repr__(self):
+        return '<{} {} ({})>'.format(self.__name__, self.location, self.__class__.__name__)
+
+    # Things that are 'alive' should return true
+    def is_alive(self):
+        return hasattr(self, 'alive') and self.alive
+
+    # Return the state of the thing that is saved in Environment.snapshot.
+    # Subclasses with more state should extend this and restore.
+    def snapshot(self):
+        return {'location': self.location, 'alive': self.alive}
+
+    def restore(self, state):
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+
+
+# This represents any non-spatial/physical artifact that can appear in an Environment.
+class NonSpatial(NamedObject):
+    pass
+
+
+# An Agent is a subclass of Thing with one required slot,
+# .program, which should hold a function that takes one argument, the
+# percept, and returns an action. (What counts as a percept or action
+# will depend on the specific environment in which the agent exists.)
+# Note that 'program' is a slot, not a method.  If it were a method,
+# then the program could 'cheat' and look at aspects of the agent.
+# It's not supposed to do that: the program can only look at the
+# percepts.  An agent program that needs a model of the world (and of
+# the agent itself) will have to build and maintain its own model.
+# There is an optional slot, .performance, which is a number giving
+# the performance measure of the agent in its environment.
+class Agent(Thing):
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, program=None, name='noname'):
+        super().__init__()
+        self.bump = False
+        self.alive = True
+        self.holding = []
+        self.__name__ = name
+        self.direction = Direction(Direction.R)
+        self.performance = 0
+        if program:
+            self.program = program
+
+    def __repr__(self):
+        return '<alive:{}, direction:{}, name:{} ({})>'.format(self.alive,
+                                                               self.direction,
+                                                               self.__name__,
+                                                               self.__class__.__name__)
+
+    # Returns True if this agent can grab this thing. Override for appropriate
+    # subclasses of Agent and Thing.
+    # _=thing
+    def can_grab(self, _):
+        return False
+
+    # The state of attributes that have snapshot and restore methods (a Network
+    # for instance) is saved as 'parts'
+    def snapshot(self):
+        state = super().snapshot()
+        state.update({'bump': self.bump,
+                      'direction': self.direction.direction,
+                      'performance': self.performance,
+                      'holding': list(self.holding)})
+        state['parts'] = {attribute: value.snapshot() for attribute, value in vars(self).items()
+                          if (not isinstance(value, Thing) and
+                              hasattr(value, 'snapshot') and hasattr(value, 'restore'))}
+        return state
+
+    def restore(self, state):
+        state = dict(state)
+        self.direction = Direction(state.pop('direction'))
+        self.holding[:] = state.pop('holding')
+        for attribute, part in state.pop('parts').items():
+            getattr(self, attribute).restore(part)
+        super().restore(state)
+
+
+# Wrap the agent's program to print its input and output. This will let
+# you see what the agent is doing in the environment.
+def trace_agent(agent):
+    old_program = agent.program
+
+    def new_program(percept):
+        action = old_program(percept)
+        print('{} perceives {} and does {}'.format(agent, percept, action))
+        return action
+    agent.program = new_program
+    return agent
+
+
+# An insertion ordered collection of NamedObjects with O(1) append, remove
+# and membership tests, used for the things and agents in an Environment.
+# Objects are identified in the same way as in NamedObject (by name).
+# It iterates, compares and prints like a list so it can be used where a list
+# of things was used before.
+#
+# items: {object: int} - the objects and the order they were added in
+class Registry:
+    def __init__(self, items=None):
+        self.items = {}
+        self.counter = 0
+        for item in items or []:
+            self.append(item)
+
+    def __repr__(self):
+        return repr(list(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    # iterates over a copy so that things can be added and deleted in a loop
+    def __iter__(self):
+        return iter(list(self.items))
+
+    def __getitem__(self, idx):
+        return list(self.items)[idx]
+
+    def __eq__(self, other):
+        if not isinstance(other, (Registry, list, tuple)):
+            return NotImplemented
+        return list(self.items) == list(other)
+
+    def append(self, item):
+        self.items[item] = self.counter
+        self.counter += 1
+
+    # Raises ValueError when item is missing (like list.remove)
+    def remove(self, item):
+        if item not in self.items:
+            raise ValueError('Registry.remove(x): x not in registry')
+        del self.items[item]
+
+    # Position of item relative to the other items, items added later have higher numbers
+    def order(self, item):
+        return self.items[item]
+
+
+# A direction class for agents that want to move in a 2D plane
+#    Usage:
+#        d = Direction("down")
+#        To change directions:
+#        d = d + "right" or d = d + Direction.R #Both do the same thing
+#        Note that the argument to __add__ must be a string and not a Direction object.
+#        Also, it (the argument) can only be right or left.
+class Direction:
+
+    R = "right"
+    L = "left"
+    U = "up"
+    D = "down"
+
+    def __init__(self, direction):
+        self.direction = direction
+
+    def __repr__(self):
+        return '{}'.format(self.direction)
+
+    def __add__(self, heading):
+        direction = TURNS.get(self.direction, {}).get(heading, None)
+        return Direction(direction) if direction else None
+
+    def move_forward(self, from_location):
+        x, y = from_location
+        if self.direction == self.R:
+            return (x + 1, y)
+        elif self.direction == self.L:
+            return (x - 1, y)
+        elif self.direction == self.U:
+            return (x, y - 1)
+        elif self.direction == self.D:
+            return (x, y + 1)
+
+
+# The direction after turning right or left {direction: {turn: direction}}
+TURNS = {Direction.R: {Direction.R: Direction.D, Direction.L: Direction.U},
+         Direction.L: {Direction.R: Direction.U, Direction.L: Direction.D},
+         Direction.U: {Direction.R: Direction.R, Direction.L: Direction.L},
+         Direction.D: {Direction.R: Direction.L, Direction.L: Direction.R}}
@@ -115,6 +115,10 @@ class WsServer:
     def send_update_terrain(self, terrain):
         self.send('w.updateTerrain(' + json.dumps(terrain) + ')')
 
+    # cells = [(x, y, code)]
+    def send_update_cells(self, cells):
+        self.send('w.updateCells(' + json.dumps(cells) + ')')
+
 
 # Main
 # ====
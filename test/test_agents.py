@@ -7,10 +7,15 @@
 # Imports
 # ======
 
+import io
+import random
 import unittest
+from contextlib import redirect_stdout
 from math import isclose
 from gzutils.gzutils import Logging
-from animatai.agents import Agent, Thing, Direction, XYEnvironment
+from animatai.agents import (Agent, Thing, Direction, XYEnvironment, Obstacle, Registry,
+                             PopulationAgent)
+from animatai.utils import distance_squared
 from animatai.network import Network
 
 # Setup logging
@@ -222,6 +227,317 @@ class TestAgents(unittest.TestCase):
         self.assertTrue(isclose(a.status['energy'], 0.999))
 
 
+    def test_spatial_index(self):
+        l.info('test_spatial_index')
+
+        def things_near(e, location, radius):
+            return [(t, radius*radius - distance_squared(location, t.location))
+                    for t in e.things if distance_squared(location, t.location) <= radius*radius]
+
+        e = XYEnvironment({'width': 20, 'height': 20})
+        a = Agent(None, 'agent')
+        e.add_thing(a, (5, 5))
+        for i in range(40):
+            e.add_thing(Thing(str(i)), (i % 7 + 2, i % 5 + 3))
+        e.add_thing(Obstacle('rock'), (6, 5))
+
+        self.assertTrue(e.some_things_at((6, 5), Obstacle))
+        self.assertTrue(e.move_to(a, (6, 5)))
+        self.assertTrue(a.location == (5, 5))
+
+        e.move_to(a, (4, 4))
+        self.assertTrue(e.list_things_at((5, 5), Agent) == [])
+        self.assertTrue(e.list_things_at((4, 4)) ==
+                        [t for t in e.things if t.location == (4, 4)])
+
+        e.delete_thing(e.things[3])
+        for radius in [0, 1, 2, 5, 30]:
+            self.assertTrue(e.things_near((4, 4), radius) == things_near(e, (4, 4), radius))
+
+        # continuous locations
+        e.add_thing(Thing('c'), (3.5, 4.25))
+        self.assertTrue(e.list_things_at((3.5, 4.25))[0].__name__ == 'c')
+        self.assertTrue(e.things_near((4, 4), 1) == things_near(e, (4, 4), 1))
+
+    def test_things_near(self):
+        l.info('test_things_near')
+
+        def things_near(e, location, radius):
+            return [(t, radius*radius - distance_squared(location, t.location))
+                    for t in e.things if distance_squared(location, t.location) <= radius*radius]
+
+        rnd = random.Random(1)
+        e = XYEnvironment({'width': 30, 'height': 30})
+        for i in range(200):
+            e.add_thing(Thing(str(i)), (rnd.randrange(30), rnd.randrange(30)))
+
+        for location in [(0, 0), (10, 12), (29, 3)]:
+            for radius in [0, 1, 2.5, 4, 40]:
+                self.assertTrue(e.things_near(location, radius) == things_near(e, location, radius))
+
+        # continuous locations
+        for i in range(50):
+            e.add_thing(Thing('c' + str(i)), (rnd.random() * 30, rnd.random() * 30))
+        for location in [(10, 12), (3.3, 7.9)]:
+            for radius in [0, 1.5, 4, 40]:
+                self.assertTrue(e.things_near(location, radius) == things_near(e, location, radius))
+
+    def test_occupancy_layers(self):
+        l.info('test_occupancy_layers')
+
+        class Squid(Thing):
+            pass
+
+        class Rock(Obstacle):
+            pass
+
+        terrain = ['RS  ',
+                   ' SS ',
+                   '  R ']
+        options = {'terrain': terrain, 'things': terrain,
+                   'ENV_ENCODING': [('R', Rock), ('S', Squid)]}
+        e1 = XYEnvironment(options)
+        e2 = XYEnvironment(dict(options, occupancy_layers=True))
+
+        for e in [e1, e2]:
+            a = Agent(None, 'agent')
+            e.add_thing(a, (3, 0))
+            e.move_to(a, (3, 1))
+            e.delete_thing(e.list_things_at((1, 1), Squid)[0])
+
+        for e in [e1, e2]:
+            self.assertTrue(e.calc_objects(Squid) == 2)
+            self.assertTrue(e.calc_objects(Obstacle) == 2)
+            self.assertTrue(e.some_things_at((2, 2), Obstacle))
+            self.assertFalse(e.some_things_at((1, 1), Thing))
+            self.assertTrue(e.list_things_at((3, 1), Agent)[0].__name__ == 'agent')
+            self.assertTrue(e.population() == {Rock: 2, Squid: 2, Agent: 1})
+            self.assertTrue(e.density(Obstacle).tolist() == [[1, 0, 0, 0],
+                                                             [0, 0, 0, 0],
+                                                             [0, 0, 1, 0]])
+
+        self.assertTrue((e2.layers[Agent] == e1.density(Agent)).all())
+
+    def test_registry(self):
+        l.info('test_registry')
+
+        things = [Thing(str(i)) for i in range(5)]
+        r = Registry(things)
+        self.assertTrue(r == things and len(r) == 5)
+        self.assertTrue(Thing('3') in r)
+
+        r.remove(things[1])
+        r.append(things[1])
+        self.assertTrue(r == [things[0], things[2], things[3], things[4], things[1]])
+        self.assertTrue(r.order(things[4]) < r.order(things[1]))
+        self.assertRaises(ValueError, r.remove, Thing('x'))
+
+        # things can be deleted while iterating
+        e = XYEnvironment()
+        for t in things:
+            e.add_thing(t, (1, 1))
+        for t in e.things:
+            if t.__name__ in ['1', '3']:
+                e.delete_thing(t)
+        self.assertTrue(e.things == [things[0], things[2], things[4]])
+        self.assertTrue(e.list_things_at((1, 1)) == [things[0], things[2], things[4]])
+
+    def test_build_world(self):
+        l.info('test_build_world')
+
+        class Squid(Thing):
+            pass
+
+        class Wss:
+            def __init__(self):
+                self.sent = []
+
+            def send_init(self, _):
+                pass
+
+            def send_update_terrain(self, terrain):
+                self.sent.append(('terrain', terrain))
+
+            def send_update_cells(self, cells):
+                self.sent.append(('cells', cells))
+
+            def send_update_agent(self, _, _2):
+                pass
+
+        terrain = ['....',
+                   '....']
+        wss = Wss()
+        e = XYEnvironment({'terrain': terrain, 'ENV_ENCODING': [('S', Squid), ('A', Agent)],
+                           'wss': wss, 'wss_cfg': {'agents': {'a': {}}}})
+        a = Agent(lambda _: 'Forward', 'a')
+        e.add_thing(a, (0, 0))
+        e.add_thing(Squid('s'), (2, 1))
+        e.step(1)
+        self.assertTrue(e.world == ['.A..', '..S.'])
+        self.assertTrue(sorted(wss.sent[-1][1]) == [(1, 0, 'A'), (2, 1, 'S')])
+
+        e.step(2)
+        self.assertTrue(e.world == ['..A.', '..S.'])
+        self.assertTrue(sorted(wss.sent[-1][1]) == [(1, 0, '.'), (2, 0, 'A')])
+
+        e.world_grid = None
+        e.build_world()
+        self.assertTrue(e.world == ['..A.', '..S.'] and e.changed_cells is None)
+
+    def test_population(self):
+        l.info('test_population')
+
+        def program(i):
+            actions = ['Forward', 'Forward', 'TurnLeft', 'Forward', 'TurnRight', 'sing']
+            step = [i]
+            def program_(_):
+                step[0] += 1
+                return actions[step[0] % len(actions)]
+            return program_
+
+        def run(agent_class, occupancy_layers):
+            e = XYEnvironment({'width': 8, 'height': 8, 'occupancy_layers': occupancy_layers})
+            for i in range(8):
+                e.add_thing(Obstacle('o' + str(i)), (i, 0))
+                e.add_thing(Obstacle('p' + str(i)), (7, i))
+            agents = [agent_class(program(i), 'a' + str(i)) for i in range(12)]
+            for i, a in enumerate(agents):
+                e.add_thing(a, (i % 6 + 1, i % 5 + 1))
+            e.delete_thing(agents[3])
+            for t in range(20):
+                e.step(t)
+            return [(a.location, a.direction.direction, a.bump) for a in agents]
+
+        res = run(Agent, False)
+        self.assertTrue(run(PopulationAgent, False) == res)
+        self.assertTrue(run(PopulationAgent, True) == res)
+
+        e = XYEnvironment()
+        a = PopulationAgent(None, 'a')
+        e.add_thing(a, (2, 3))
+        a.direction += Direction.L
+        self.assertTrue(e.agent_population.headings[a.index] == 3)
+        e.delete_thing(a)
+        self.assertTrue(a.location == (2, 3) and a.direction.direction == Direction.U)
+
+    def test_reward_table(self):
+        l.info('test_reward_table')
+
+        class Food(Thing):
+            pass
+
+        class Squid(Food):
+            pass
+
+        # the rewards calculation before it was compiled
+        def calc_performance(e, agent, action):
+            rewards = {}
+            for rewarded_action, object_and_objectives in e.options.rewards.items():
+                if action == rewarded_action or rewarded_action is None:
+                    for rewarded_thing, obj_and_reward in object_and_objectives.items():
+                        if ((rewarded_thing and e.list_things_at(agent.location, rewarded_thing)) or
+                                rewarded_thing is None):
+                            for obj, rew in obj_and_reward.items():
+                                if obj not in rewards:
+                                    rewards[obj] = rew
+            return rewards
+
+        options = {
+            'objectives': {'energy': 1.0, 'water': 1.0},
+            'rewards': {
+                None: {Obstacle: {'water': -1.0}},
+                'eat': {Squid: {'energy': 0.2}, Food: {'energy': 0.1, 'water': 0.1},
+                        None: {'energy': -0.05}},
+                'drink': {None: {'water': 0.1}},
+            }
+        }
+        e = XYEnvironment(options)
+        a = Agent(None, 'a')
+        e.add_thing(a, (1, 1))
+        e.add_thing(Squid('s'), (2, 1))
+        e.add_thing(Food('f'), (3, 1))
+        e.add_thing(Obstacle('o'), (3, 1))
+        for x in [1, 2, 3]:
+            e.move_thing(a, (x, 1))
+            for action in ['eat', 'drink', 'Forward', None]:
+                self.assertTrue(e.calc_performance(a, action) == calc_performance(e, a, action))
+
+    def test_headless_run(self):
+        l.info('test_headless_run')
+
+        class Observer:
+            def __init__(self):
+                self.steps = 0
+
+            def env_step(self, _):
+                self.steps += 1
+
+            def thing_moved(self, _):
+                pass
+
+        def run(headless):
+            e = XYEnvironment({'width': 6, 'height': 6})
+            for i in range(3):
+                e.add_thing(Agent(lambda _: 'Forward', 'a' + str(i)), (0, i))
+            obs = Observer()
+            e.add_observer(obs)
+            out = io.StringIO()
+            with redirect_stdout(out):
+                e.run(5, headless)
+            return [a.location for a in e.agents], obs.steps, out.getvalue(), e
+
+        locations, steps, _, _ = run(False)
+        locations1, steps1, output, e = run(True)
+        self.assertTrue(locations == locations1 == [(5, 0), (5, 1), (5, 2)])
+        self.assertTrue(steps == steps1 == 5)
+        self.assertTrue(len(output.splitlines()) == 1 and 'steps/second' in output)
+        self.assertTrue(e.steps_per_second > 0 and not e.headless)
+
+    def test_snapshot(self):
+        l.info('test_snapshot')
+
+        class Squid(Thing):
+            pass
+
+        class Cachelot(PopulationAgent):
+            def __init__(self, name):
+                super().__init__(None, name)
+                self.network = Network([('squid', Squid)], {'energy': 1.0})
+                self.status = self.network.get_NEEDs()
+
+            def program(self, percept):
+                self.network.update(percept)
+                return random.choice(['Forward', 'TurnLeft', 'TurnRight', 'eat'])
+
+        options = {'width': 10, 'height': 10, 'occupancy_layers': True,
+                   'objectives': {'energy': 1.0},
+                   'rewards': {'eat': {Squid: {'energy': 0.1}}, None: {None: {'energy': -0.01}}}}
+        e = XYEnvironment(options)
+        agents = [Cachelot('c' + str(i)) for i in range(3)] + [Agent(lambda _: 'Forward', 'a')]
+        for i, a in enumerate(agents):
+            e.add_thing(a, (i + 2, i + 2))
+        for i in range(10):
+            e.add_thing(Squid(str(i)), (i, (3 * i) % 10))
+
+        def rollout():
+            with redirect_stdout(io.StringIO()):
+                for t in range(10):
+                    e.step(t)
+            if agents[0] in e.things:
+                e.delete_thing(agents[0])
+            e.add_thing(Squid('new'), (1, 1))
+            return ([(a.location, a.direction.direction, a.performance, dict(a.status))
+                     for a in agents[:3]] + [e.density(Squid).tolist()])
+
+        with redirect_stdout(io.StringIO()):
+            e.step(0)
+        snapshot = e.snapshot()
+        res = rollout()
+        for _ in range(2):
+            e.restore(snapshot)
+            self.assertTrue(len(e.things) == 14 and e.calc_objects(Squid) == 10)
+            self.assertTrue(rollout() == res)
+
     def tearDown(self):
         l.info('...done with test_agents.')
 
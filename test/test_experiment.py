@@ -0,0 +1,85 @@
+# pylint: disable=missing-docstring, global-statement, invalid-name, too-few-public-methods
+#
+# Copyright (C) 2017  Jonas Colmsjö, Claes Strannegård
+#
+
+
+# Imports
+# ======
+
+import random
+import unittest
+
+from gzutils.gzutils import Logging
+from animatai.agents import Agent, Thing, XYEnvironment
+from animatai.experiment import run_experiments
+from animatai.history import History
+
+
+# Setup logging
+# =============
+
+DEBUG_MODE = True
+l = Logging('test_experiment', DEBUG_MODE)
+
+
+class Squid(Thing):
+    pass
+
+
+def random_program(_):
+    return random.choice(['Forward', 'TurnLeft', 'TurnRight'])
+
+
+def world_factory(config):
+    e = XYEnvironment({'width': config['size'], 'height': config['size'],
+                       'objectives': {'energy': 1.0},
+                       'rewards': {'Forward': {Squid: {'energy': 0.1}, None: {'energy': -0.01}}}})
+    History.add_env_classes(e, [Squid])
+    e.add_observer(History, e)
+    for i in range(3):
+        agent = Agent(random_program, 'agent' + str(i))
+        e.add_thing(agent, (i, i))
+        e.add_observer(History, agent)
+    for i in range(config['size']):
+        e.add_thing(Squid('squid' + str(i)), (i, config['size'] - 1 - i))
+    return e
+
+
+class TestExperiment(unittest.TestCase):
+
+    def setUp(self):
+        l.info('Testing experiment...')
+        self.saved = History.dump()
+        History.reset()
+
+    def tearDown(self):
+        History.reset()
+        History.merge(self.saved)
+        l.info('...done with test_experiment.')
+
+    def test_run_experiments(self):
+        configs = [{'seed': seed, 'size': size} for seed in [1, 2] for size in [5, 8]]
+
+        serial = run_experiments(world_factory, configs, 20, processes=1)
+        serial_history = History.dump()
+        self.assertTrue(serial_history['history']['run3:agent2'])
+        self.assertTrue(History.get()[0][0] == 'run0:noname')
+
+        History.reset()
+        parallel = run_experiments(world_factory, configs, 20, processes=2)
+
+        for r1, r2 in zip(serial, parallel):
+            self.assertTrue(r1['history'] == r2['history'])
+            self.assertTrue(r1['agents'] == r2['agents'])
+        self.assertTrue(History.dump() == serial_history)
+
+        # runs with different seeds differ
+        self.assertTrue(serial[0]['history'] != serial[2]['history'])
+
+
+# Main
+# ====
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,15 @@
 # Imports
 # ======
 
+import io
+import pickle
+import random
+import sys
 import unittest
 from gzutils.gzutils import Logging, unpack
 from animatai.agents import Thing
-from animatai.network import Network, MotorNetwork
+from animatai.network import Network, MotorNetwork, Node
+from animatai.network_batch import BatchNetwork, SharedNetwork, Topology
 
 
 # Setup logging
@@ -30,6 +35,33 @@ class Thing2:
 class Thing3:
     pass
 
+# Build the same random network in each of the networks, all node types are used
+def build_random_network(networks, size, seed, rand=True):
+    rnd = random.Random(seed)
+    for network in networks:
+        for cls in [Thing1, Thing2, Thing3]:
+            network.add_SENSOR_node(cls)
+        if rand:
+            network.add_RAND_node(0.5)
+    for _ in range(size):
+        kind = rnd.choice(['AND', 'OR', 'NOT', 'ONE', 'MIN', 'MAX', 'SEQ'])
+        n = len(networks[0].nodes)
+        indexes = rnd.sample(range(n), min(n, rnd.randint(1, 3)))
+        arg = rnd.choice(indexes) if kind == 'ONE' else rnd.randint(0, 2)
+        for network in networks:
+            if kind == 'ONE':
+                network.add_ONE_node(arg, indexes)
+            elif kind in ['MIN', 'MAX']:
+                getattr(network, 'add_' + kind + '_node')(arg, indexes)
+            else:
+                getattr(network, 'add_' + kind + '_node')(indexes)
+
+def random_percepts(steps, seed):
+    rnd = random.Random(seed)
+    return [([(cls(), 1.0) for cls in [Thing1, Thing2, Thing3] if rnd.random() < 0.5], {})
+            for _ in range(steps)]
+
+
 class TestNetwork(unittest.TestCase):
     # pylint: disable=too-many-locals
 
@@ -84,6 +116,17 @@ class TestNetwork(unittest.TestCase):
         network.update(([], {}))
         self.assertTrue(network.get_state() == (False, False, False))
 
+    def test_long_SEQ(self):
+        network = Network([('thing1', Thing1), ('thing2', Thing2)])
+        n3 = network.add_SEQ_node([0] * 49 + [1])
+        for _ in range(49):
+            network.update(([(Thing1(), 1.0)], {}))
+            self.assertFalse(network.state[n3])
+        self.assertTrue(network.nodes[n3].vars_ == (1 << 49) - 1)
+        network.update(([(Thing2(), 1.0)], {}))
+        self.assertTrue(network.state[n3])
+        self.assertTrue(network.nodes[n3].vars_ == 0)
+
     def test_top_active(self):
         network = Network()
         n1 = network.add_SENSOR_node(Thing1)
@@ -114,6 +157,19 @@ class TestNetwork(unittest.TestCase):
         network.update(([(Thing3(), 1.0)], {}))
         self.assertTrue(network.get() == set([n3, n4]))
 
+    def test_top_active_shared(self):
+        network = Network(bitset=True)
+        n1 = network.add_SENSOR_node(Thing1)
+        n2 = network.add_SENSOR_node(Thing2)
+        layer = [n1, n2]
+        for _ in range(100):
+            layer = [network.add_AND_node(layer), network.add_AND_node(layer)]
+        top = network.add_OR_node([n1] + layer)
+
+        self.assertTrue(network.top_active(([(Thing1(), 1.0)], {})) == 1 << top)
+        network.state[top] = False
+        self.assertTrue(network.top_active() == 1 << n1)
+
     def test_RAND_NOT(self):
         network = Network()
         n1 = network.add_RAND_node(0.5)
@@ -193,6 +249,252 @@ class TestNetwork(unittest.TestCase):
             vs = vs & {s1, n2, n3, n4}
             self.assertTrue(len(vs) == 1)
 
+    def test_plan(self):
+        network = Network([('thing1', Thing1), ('thing2', Thing2)])
+        n3 = network.add_AND_node([0, 1])
+        n4 = network.add_OR_node([0, 1])
+        n5 = network.add_AND_node([n3, n4])
+        self.assertTrue(network.get_plan() == [0, 1, n3, n4, n5])
+
+        # the plan is recompiled when nodes are added and deleted
+        n6 = network.add_NOT_node([n5])
+        self.assertTrue(network.get_plan() == [0, 1, n3, n4, n5, n6])
+        network.delete_nodes([n6])
+        self.assertTrue(network.get_plan() == [0, 1, n3, n4, n5])
+
+        # deep networks are evaluated without recursion
+        idx = n5
+        for _ in range(5000):
+            idx = network.add_AND_node([idx, 0])
+        network.update(([(Thing1(), 1.0), (Thing2(), 1.0)], {}))
+        self.assertTrue(len(network.get_plan()) == len(network.nodes) - 1)
+        self.assertTrue(network.state[idx])
+        network.update(([(Thing1(), 1.0)], {}))
+        self.assertTrue(network.get() == set([0, n4]))
+
+    def test_bitset(self):
+        network = Network([('thing1', Thing1), ('thing2', Thing2)], bitset=True)
+        n3 = network.add_AND_node([0, 1])
+        self.assertTrue(unpack0(network.update(([(Thing2(), 1.0)], {}))) == 0b010)
+        self.assertTrue(network.get() == 0b010)
+        network.update(([(Thing1(), 1.0), (Thing2(), 1.0)], {}))
+        self.assertTrue(network.get() == 0b111)
+        self.assertTrue(network.top_active() == 1 << n3)
+        network.update(([], {}))
+        self.assertTrue(network.get() == 0 and network.top_active() == 0)
+
+    def test_vectorized(self):
+        network, vectorized = Network(), Network(vectorized=True)
+        build_random_network([network, vectorized], 200, 1)
+        vectorized.delete_nodes([len(network.nodes) - 1])
+        network.delete_nodes([len(network.nodes) - 1])
+        self.assertTrue(len(vectorized.get_layers().stages) > 2)
+
+        for i, percept in enumerate(random_percepts(50, 2)):
+            random.seed(i)
+            network.update(percept)
+            random.seed(i)
+            vectorized.update(percept)
+            self.assertTrue(network.get_state() == vectorized.get_state())
+
+    def test_incremental(self):
+        network, incremental = Network(), Network(incremental=True)
+        build_random_network([network, incremental], 200, 4)
+        percepts = random_percepts(10, 5)
+        percepts = [percept for percept in percepts for _ in range(3)]
+
+        for i, percept in enumerate(percepts):
+            if i == 15:
+                network.add_OR_node([0, 5])
+                incremental.add_OR_node([0, 5])
+            random.seed(i)
+            network.update(percept)
+            random.seed(i)
+            incremental.update(percept)
+            self.assertTrue(network.get_state() == incremental.get_state())
+
+    def test_profiling(self):
+        network = Network([('thing1', Thing1), ('thing2', Thing2)], incremental=True)
+        n3 = network.add_NOT_node([0])
+        n4 = network.add_AND_node([0, n3])
+        network.add_OR_node([0, 1])
+
+        profile = network.start_profiling()
+        for percept in random_percepts(20, 10):
+            network.update(percept)
+        self.assertTrue(profile.steps == 20 and profile.counts == [20] * 5)
+        self.assertTrue(profile.dead_nodes() == [n4])
+        self.assertTrue(profile.frequency(0) + profile.frequency(n3) == 1.0)
+        report = network.profile_report()
+        self.assertTrue(len(report) == 5 and report[0]['time'] >= report[-1]['time'])
+        self.assertTrue('fillcolor=lightgray' in network.toGraphviz(profile=profile))
+
+        self.assertTrue(network.stop_profiling() is profile)
+        network.update(([], {}))
+        self.assertTrue(profile.steps == 20 and network.profile is None)
+
+    def test_graphviz(self):
+        network = Network([('thing1', Thing1), ('thing2', Thing2), ('thing3', Thing3)])
+        n4 = network.add_AND_node([0, 1])
+        n5 = network.add_OR_node([n4, 2])
+        n6 = network.add_NOT_node([n5])
+        network.delete_nodes([n6])
+        network.update(([(Thing1(), 1.0), (Thing3(), 1.0)], {}))
+
+        def nodes(**filters):
+            filep = io.StringIO()
+            network.writeGraphviz(filep, **filters)
+            lines = filep.getvalue().split('\n')
+            return set([int(line.split()[0]) for line in lines if '[label=' in line])
+
+        self.assertTrue(nodes() == set([0, 1, 2, n4, n5]))
+        self.assertTrue(nodes(active_only=True) == set([0, 2, n5]))
+        self.assertTrue(nodes(max_depth=1) == set([n4, n5, 2]))
+        self.assertTrue(nodes(around=[0]) == set([0, n4]))
+        self.assertTrue(nodes(around=[0], radius=2) == set([0, 1, n4, n5]))
+        self.assertTrue('0->3' in network.toGraphviz() and '0->3' not in
+                        network.toGraphviz(around=[0], radius=0))
+
+    def test_add_nodes(self):
+        network = Network()
+        build_random_network([network], 100, 8)
+        bulk = Network()
+        bulk.add_nodes([(node.kind, node.args, node.children) for node in network.nodes])
+        self.assertTrue(bulk.root_indexes() == network.root_indexes())
+        self.assertTrue(bulk.get_plan() == network.get_plan())
+        for percept in random_percepts(10, 9):
+            random.seed(1)
+            network.update(percept)
+            random.seed(1)
+            bulk.update(percept)
+            self.assertTrue(network.get_state() == bulk.get_state())
+
+        network = Network()
+        n1, n2, n3, n4 = network.add_nodes([('SENSOR', (Thing1, None), []),
+                                            ('SENSOR', (Thing2, None), []),
+                                            ('AND', None, [0, 1]),
+                                            ('OR', None, [0, 1])])
+        self.assertTrue(network.root_indexes() == [n3, n4])
+        network.delete_nodes([n3])
+        self.assertTrue(network.root_indexes() == [n4])
+        network.delete_nodes([n4])
+        self.assertTrue(network.root_indexes() == [n1, n2])
+        self.assertRaises(ValueError, network.add_nodes, [('AND', None, [n3])])
+        self.assertRaises(ValueError, network.add_nodes, [('AND', None, [5])])
+        self.assertRaises(ValueError, network.add_nodes, [('AND', None, [-1])])
+
+        # a bad spec in the middle of the batch leaves the network unchanged
+        self.assertRaises(ValueError, network.add_nodes, [('OR', None, [n1, n2]),
+                                                          ('AND', None, [n3]),
+                                                          ('NOT', None, [n1])])
+        self.assertTrue(len(network.nodes) == len(network.state) == 4)
+        self.assertTrue(network.root_indexes() == [n1, n2])
+        self.assertTrue(network.add_nodes([('NOT', None, [n1])]) == [4])
+
+    def test_serialize(self):
+        network = Network(None, {'energy': 1.0})
+        build_random_network([network], 200, 6, rand=False)
+        network.delete_nodes([len(network.nodes) - 1])
+        percepts = random_percepts(20, 7)
+        for percept in percepts[:10]:
+            network.update((percept[0], {'energy': -0.1}))
+
+        loaded = pickle.loads(pickle.dumps(network))
+        self.assertTrue(loaded.get_state() == network.get_state())
+        self.assertTrue(loaded.get_NEEDs() == network.get_NEEDs())
+        self.assertTrue(loaded.root_nodes == [loaded.nodes[network.nodes.index(node)]
+                                              for node in network.root_nodes])
+        for percept in percepts[10:]:
+            self.assertTrue(loaded.update(percept) == network.update(percept))
+
+        loaded = Network.from_dict(network.to_dict())
+        self.assertTrue(loaded.get_state() == network.get_state())
+
+        network.add_root_node(Node('CUSTOM', lambda _, _2: (True, []), [], []))
+        self.assertRaises(ValueError, network.to_dict)
+
+    def test_replay(self):
+        network = Network()
+        build_random_network([network], 200, 11, rand=False)
+        network.add_SEQ_node([0, 1, 2, 0, 1])
+        percepts = [percept for percept, _ in random_percepts(40, 12)]
+        for percept in percepts[:5]:
+            network.update((percept, {}))
+
+        vars_ = [node.vars_ for node in network.nodes]
+        activations = network.replay(percepts[5:])
+        self.assertTrue([node.vars_ for node in network.nodes] == vars_)
+        self.assertTrue((network.replay(network.sensor_matrix(percepts[5:])) == activations).all())
+        self.assertTrue(activations.shape == (35, len(network.nodes)))
+        for step, percept in enumerate(percepts[5:]):
+            network.update((percept, {}))
+            self.assertTrue(tuple(activations[step].tolist()) == network.get_state())
+
+    def test_batch(self):
+        networks = [Network(None, {'energy': 1.0}, bitset=True) for _ in range(6)]
+        build_random_network(networks, 100, 3, rand=False)
+        networks[0].update(([(Thing1(), 1.0)], {'energy': -0.5}))
+        batch = BatchNetwork(networks[0], 5)
+        for network in networks[1:]:
+            network.restore(networks[0].snapshot())
+
+        percepts = [random_percepts(30, seed) for seed in range(5)]
+        for t in range(30):
+            batch_percept = [(percepts[i][t][0], {'energy': -0.1 * i}) for i in range(5)]
+            keys = batch.update(batch_percept)
+            for i, network in enumerate(networks[1:]):
+                self.assertTrue(unpack0(network.update(batch_percept[i])) == keys[i])
+                self.assertTrue(network.get_NEEDs() == batch.get_NEEDs(i))
+
+        self.assertTrue(BatchNetwork(Network([('thing1', Thing1)]), 2).update([([], {})] * 2) ==
+                        [frozenset(), frozenset()])
+
+    def test_sensor_dispatch(self):
+        class Thing4(Thing1):
+            pass
+
+        network = Network()
+        n1 = network.add_SENSOR_node(Thing1)
+        n2 = network.add_SENSOR_node(Thing4)
+        n3 = network.add_SENSOR_node(Thing1, 'one')
+        n4 = network.add_SENSOR_node(Thing4, 'one')
+        n5 = network.add_SENSOR_node(Thing2)
+        n6 = network.add_AND_node([n1, n5])
+
+        self.assertTrue(unpack0(network.update(([(Thing4('two'), 1.0)], {}))) == set([n1, n2]))
+        self.assertTrue(unpack0(network.update(([(Thing1('one'), 1.0)], {}))) == set([n1, n3]))
+        self.assertTrue(unpack0(network.update(([(Thing4('one'), 1.0), (Thing2(), 1.0)], {}))) ==
+                        set([n1, n2, n3, n4, n5, n6]))
+        self.assertTrue(unpack0(network.update(([(Thing3(), 1.0)], {}))) == set())
+        self.assertTrue(set(network.get_sensors().dispatch) == {Thing1, Thing2, Thing3, Thing4})
+
+    def test_shared_topology(self):
+        networks = [Network(None, {'energy': 1.0}) for _ in range(3)]
+        build_random_network(networks, 100, 13)
+        # agents do not start with the state of a template that has been used
+        for step in range(5):
+            networks[0].update((random_percepts(1, 14 + step)[0][0], {'energy': -0.1}))
+        topology = Topology(networks[0])
+        shared = [SharedNetwork(topology) for _ in range(2)]
+        self.assertTrue(shared[0].registers == [0] * topology.register_count)
+        self.assertTrue(shared[0].get_NEEDs() == {'energy': 1.0})
+        snapshot = shared[0].snapshot()
+
+        for step in range(20):
+            for i, network in enumerate(shared):
+                percept = (random_percepts(1, 100 * i + step)[0][0], {'energy': -0.1 * i})
+                random.seed(step)
+                key = network.update(percept)[0]
+                random.seed(step)
+                self.assertTrue(key == networks[i + 1].update(percept)[0])
+                self.assertTrue(network.get_NEEDs() == networks[i + 1].get_NEEDs())
+
+        shared[1].restore(snapshot)
+        self.assertTrue(shared[1].get_NEEDs() == {'energy': 1.0} and not shared[1].get())
+        size = (sys.getsizeof(shared[1]) + sys.getsizeof(shared[1].values) +
+                sys.getsizeof(shared[1].registers) + sys.getsizeof(shared[1].needs))
+        self.assertTrue(size < 1000)
+
     def test_NEED(self):
         N = Network(None, {'energy': 1.0})
 
@@ -258,6 +560,71 @@ class TestMotorNetwork(unittest.TestCase):
         mnetwork.update(set([n4]))
         self.assertTrue(mnetwork.get() == set([n4]))
 
+    def test_serialize(self):
+        mnetwork = MotorNetwork(['m1', 'm2', 'm3'], {frozenset([0, 1]): 'a', '*': '-'})
+        n4 = mnetwork.add_MAND_node([0, 1])
+        n5 = mnetwork.add_MSEQ_node([n4, 2])
+        mnetwork.update(set([n5]))
+
+        loaded = pickle.loads(pickle.dumps(mnetwork))
+        self.assertTrue(loaded.motors == [0, 1, 2] and loaded.motor_names == ['m1', 'm2', 'm3'])
+        self.assertTrue(loaded.get() == set([0, 1]))
+        loaded.update(set())
+        self.assertTrue(loaded.get() == set([2]))
+        loaded.update(set([n4]))
+        self.assertTrue(loaded.get_action() == 'a')
+
+    def test_add_nodes(self):
+        mnetwork = MotorNetwork(['m1'])
+        n2, n3, n4 = mnetwork.add_nodes([('MOTOR', 'm2', []), ('MAND', None, [0, 1]),
+                                         ('MOTOR', 'm3', [])])
+        self.assertTrue(mnetwork.motors == [0, n2, n4])
+        self.assertTrue(mnetwork.motor_names == ['m1', 'm2', 'm3'])
+        mnetwork.update(set([n3]))
+        self.assertTrue(mnetwork.get() == set([0, n2]))
+
+        self.assertRaises(ValueError, mnetwork.add_nodes, [('MOTOR', 'm4', []),
+                                                           ('MAND', None, [9]),
+                                                           ('MOTOR', 'm5', [])])
+        self.assertTrue(len(mnetwork.nodes) == 4)
+        self.assertTrue(mnetwork.motors == [0, n2, n4])
+        self.assertTrue(mnetwork.motor_names == ['m1', 'm2', 'm3'])
+        mnetwork.update(set([n3]))
+        self.assertTrue(mnetwork.get() == set([0, n2]))
+
+    def test_compiled(self):
+        mnetwork = MotorNetwork(['m1', 'm2', 'm3'], {frozenset([0, 1]): 'a',
+                                                     frozenset([2]): 'b', '*': '-'})
+        n4 = mnetwork.add_MAND_node([0, 1])
+        n5 = mnetwork.add_MAND_node([2])
+        n6 = mnetwork.add_MSEQ_node([n4, n5])
+        self.assertTrue(mnetwork.update(set([n4])) == 'a')
+        self.assertTrue(mnetwork.get_mask() == 0b011)
+        self.assertTrue(mnetwork.update(set([n6])) == 'a')
+        self.assertTrue(mnetwork.update(set()) == 'b' and mnetwork.get_mask() == 0b100)
+        self.assertTrue(mnetwork.update(set([n4, n5])) == '-')
+
+        mnetwork.motors_to_action[frozenset([0, 1, 2])] = 'c'
+        mnetwork.invalidate()
+        self.assertTrue(mnetwork.update(set([n4, n5])) == 'c')
+
+    def test_change_motors_to_action(self):
+        mnetwork = MotorNetwork(['m1', 'm2'], {frozenset([0]): 'a', '*': '-'})
+        mnetwork.update(set([0]))
+        self.assertTrue(mnetwork.get_action() == 'a')
+
+        mnetwork.motors_to_action = {frozenset([0]): 'b', '*': '-'}
+        self.assertTrue(mnetwork.get_action() == 'b')
+
+        # changes in place are used after invalidate()
+        mnetwork.motors_to_action[frozenset([0])] = 'c'
+        mnetwork.invalidate()
+        self.assertTrue(mnetwork.get_action() == 'c')
+
+        del mnetwork.motors_to_action[frozenset([0])]
+        mnetwork.invalidate()
+        self.assertTrue(mnetwork.get_action() == '-')
+
     def test_motor_to_action(self):
 
         # set([(active_motors, action)])
@@ -13,7 +13,7 @@ import unittest
 from gzutils.gzutils import Logging, get_output_dir, save_csv_file
 
 from animatai.mdp import MDP
-from animatai.network_rl import NetworkDP, NetworkQLearningAgent
+from animatai.network_rl import NetworkDP, NetworkModel, NetworkQLearningAgent
 
 # Setup logging
 # =============
@@ -433,3 +433,49 @@ class TestNetworkRL(unittest.TestCase):
 
         save_csv_file('two_dim.csv', [self.multi_dim_ndp.history], self.ndp.history_headers, OUTPUT_DIR)
         l.debug('test_multiDimNetworkQLearnigAgent:', self.multi_dim_ndp.statuses)
+
+    def test_networkModelBitset(self):
+        network_model = NetworkModel({frozenset([0]): 'a', frozenset([0, 2]): 'b', 4: 'c'})
+        self.assertTrue(network_model(frozenset([0])) == 'a')
+        self.assertTrue(network_model(0b1) == 'a')
+        self.assertTrue(network_model(0b101) == 'b')
+        self.assertTrue(network_model(4) == 'c')
+        self.assertTrue(network_model(0b10) == 0b10)
+        self.assertTrue(network_model(True) is True)
+
+    def test_snapshotRestore(self):
+        q_agent = NetworkQLearningAgent(self.ndp, Ne=5, Rplus=2,
+                                        alpha=lambda n: 60./(59+n),
+                                        delta=0.5,
+                                        max_iterations=100,
+                                        calc_status=True)
+        q_agent.reset()
+        run_single_trial(q_agent, self.test_mdp, self.sensor_model, self.motor_model)
+
+        def fields():
+            return {'Q': {status: dict(Q) for status, Q in q_agent.Q.items()},
+                    'Nsa': dict(q_agent.Nsa),
+                    'history': list(q_agent.history),
+                    'ndp_history': list(q_agent.ndp.history),
+                    'status_history': {status: list(history)
+                                       for status, history in q_agent.status_history.items()},
+                    'statuses': dict(q_agent.ndp.statuses),
+                    'state_action': (q_agent.s, q_agent.ps, q_agent.a, q_agent.pa,
+                                     q_agent.r, q_agent.pr),
+                    'iterations': q_agent.iterations,
+                    'in_terminal': q_agent.in_terminal}
+
+        expected = fields()
+        snapshot = q_agent.snapshot()
+
+        q_agent.reset()
+        run_single_trial(q_agent, self.test_mdp, self.sensor_model, self.motor_model)
+        self.assertTrue(fields() != expected)
+
+        q_agent.restore(snapshot)
+        self.assertTrue(fields() == expected)
+
+        # the snapshot is not changed by running the agent after a restore
+        run_single_trial(q_agent, self.test_mdp, self.sensor_model, self.motor_model)
+        q_agent.restore(snapshot)
+        self.assertTrue(fields() == expected)